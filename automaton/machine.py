@@ -4,9 +4,10 @@ import logging
 import time
 
 from collections import deque
-from kontrol.fsm import Aborted, FSM, diagnostic
+from kontrol.fsm import Aborted, FSM, Park, diagnostic
+from kontrol.reaper import spawn
 from os.path import abspath
-from subprocess import Popen, PIPE, STDOUT
+from subprocess import PIPE, STDOUT
 
 
 #: our ochopod logger
@@ -88,15 +89,15 @@ class Actor(FSM):
                             'INPUT': msg.extra
                         }
 
-                        data.tick = time.time()
-                        data.pid = Popen(self.cur['shell'],
+                        data.child = spawn(self.actor_ref, self.cur['shell'],
                         close_fds=True,
                         bufsize=0,
                         shell=True,
                         env=env,
                         stderr=STDOUT,
-                        stdout=PIPE)
-                        logger.debug('%s : invoking script (pid %s)' % (self.path, data.pid.pid))
+                        stdout=PIPE,
+                        sink=self._sink)
+                        logger.debug('%s : invoking script (pid %s)' % (self.path, data.child.pid))
 
                         #
                         # - if we are not blocking send the 'OK' ack immediately
@@ -105,7 +106,7 @@ class Actor(FSM):
                         if not msg.wait:
                             self._ack(msg, 'OK')
 
-                        return 'wait_for_completion', data, 0.25
+                        return 'wait_for_completion', data, Park()
 
                 logger.warning('%s : %s -> %s is not allowed, skipping' % (self.path, self.cur['tag'], msg.state))
 
@@ -120,15 +121,20 @@ class Actor(FSM):
             self.fifo.popleft()
             if msg.cnx:
                 self._ack(msg, 'KO')
-            
-        return 'initial', data, 0.25
+
+        #
+        # - park until the next command comes in
+        #
+        return 'initial', data, Park()
 
     def wait_for_completion(self, data):
 
         #
         # - check if the subprocess is done or not
+        # - we are resumed either by the reaper or by an incoming command
         #
-        complete = data.pid.poll() is not None
+        out = data.child.done()
+        complete = out is not None
 
         #
         # - the process either completed or we have buffered state transitions
@@ -138,16 +144,14 @@ class Actor(FSM):
         # - pop the FIFO and cycle back to the initial state
         #
         if complete or len(self.fifo) > 1:
+            pid = data.child.pid
             if not complete:
-                logger.warning('%s : killing pid %s (%d transitions pending)' % (self.path, data.pid.pid, len(self.fifo) - 1))
-                data.pid.kill()
+                logger.warning('%s : killing pid %s (%d transitions pending)' % (self.path, pid, len(self.fifo) - 1))
+                data.child.popen.kill()
 
-            lapse = time.time() - data.tick
-            code = data.pid.returncode if complete else '_'
-            stdout = [line.rstrip('\n') for line in iter(data.pid.stdout.readline, b'')]
-            logger.debug('%s : script took %2.1f s (pid %s, exit %s)' % (self.path, lapse, data.pid.pid, code))
-            if stdout:
-                logger.debug('%s : stderr (pid %s) -> \n  . %s' % (self.path, data.pid.pid, '\n  . '.join(stdout)))
+            lapse = time.time() - data.child.tick
+            code = out['code'] if complete else '_'
+            logger.debug('%s : script took %2.1f s (pid %s, exit %s)' % (self.path, lapse, pid, code))
 
             #
             # - if blocking send back the 'OK' ack
@@ -157,11 +161,12 @@ class Actor(FSM):
             if msg.wait:
                 self._ack(msg, 'OK')
 
-            data.pid = None
+            data.child.close()
+            data.child = None
             self.fifo.popleft()
             return 'initial', data, 0
         
-        return 'wait_for_completion', data, 0.25
+        return 'wait_for_completion', data, Park()
 
     def specialized(self, msg):
         assert 'request' in msg, 'bogus message received ?'
@@ -187,6 +192,14 @@ class Actor(FSM):
         else:
             super(Actor, self).specialized(msg)
 
+    def _sink(self, pid, tag, line):
+
+        #
+        # - stream the script output (stderr is redirected to stdout) to our logger as it comes
+        # - please note this is invoked from the capture thread
+        #
+        logger.debug('%s : stdout (pid %s) -> %s' % (self.path, pid, line))
+
     def _ack(self, msg, code):
         if msg.cnx is not None:
             try:
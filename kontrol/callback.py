@@ -1,18 +1,29 @@
+import base64
 import etcd
+import hashlib
 import json
 import logging
-import time
+import os
+import zlib
 
 from collections import deque
 from etcd import EtcdKeyNotFound
-from kontrol.fsm import Aborted, FSM
-from subprocess import Popen, PIPE, STDOUT
+from kontrol.capture import LIMIT
+from kontrol.fsm import Aborted, FSM, Park
+from kontrol.reaper import spawn, spill, stderr_sink
+from kontrol.snapshot import diff, merge
+from kontrol.watcher import Watcher
+from kontrol.worker import Worker
+from subprocess import PIPE, STDOUT
 from threading import Thread
 
 
 #: our ochopod logger
 logger = logging.getLogger('kontrol')
 
+#: prefix marking a chunked state manifest (user state being JSON it can't start with that)
+CHUNKED = 'kontrol:chunked:'
+
 
 class Actor(FSM):
 
@@ -20,6 +31,13 @@ class Actor(FSM):
     State machine responsible for running the update callback (e.g whenever the observed
     MD5 digest changes). Please note this should only ever be scheduled on one single
     pod at any given time (e.g on the leading pod).
+
+    At most one invocation is pending at any given time : newer requests replace it (latest
+    wins). If $KONTROL_PREEMPT is set the running callback is also killed as soon as a newer
+    request comes in.
+
+    The persistent user-data is cached along with its etcd index and a watch on its key tells
+    us if anybody else changes it. Large values are compressed and split into chunks.
     """
 
     tag = 'callback'
@@ -29,12 +47,26 @@ class Actor(FSM):
 
         self.cfg = cfg
         self.client = etcd.Client(host=cfg['etcd'], port=2379)
+        self.digest = None
         self.fifo = deque()
+        self.generation = 0
+        self.index = None
         self.path = '%s actor' % self.tag
+        self.sink = stderr_sink(self.path)
+        self.state = None
+        self.watcher = None
+        self.worker = None
 
     def reset(self, data):
 
+        self._cleanup(data)
         if self.terminate:
+            if self.worker:
+                self.worker.stop()
+
+            if self.watcher:
+                self.watcher.stop()
+
             super(Actor, self).reset(data)
 
         return 'initial', data, 0.0
@@ -45,74 +77,149 @@ class Actor(FSM):
             raise Aborted('resetting')
 
         #
-        # - just spin if there is nothing to invoke
+        # - just park if there is nothing to invoke
+        # - the next incoming message will resume us
         #
         if not self.fifo:
-            return 'initial', data, 0.25
+            return 'initial', data, Park()
 
         #
         # - set the popen call to use piping if required
         # - spawn an ancillary thread to forward the lines to our logger
         # - this thread will go down automatically when the sub-process does
         # - set the $STATE env. variable which contains the persistent user-data
+        # - set the $DIFF env. variable if the leader knows what changed since the last invocation
+        # - if the user-data can't be read the callback runs without it and its output is discarded
         #
         msg = self.fifo[0]
-        try:
-            raw = self.client.read('/kontrol/%s/state' % self.cfg['labels']['app']).value
-            if raw:
-                msg.env['STATE'] = raw
-        except EtcdKeyNotFound:
-            pass
+        if hasattr(msg, 'changes'):
+            msg.env['DIFF'] = json.dumps(diff(msg.changes))
 
+        msg.readonly = self.state is None and not self._load()
+        if self.state:
+            msg.env['STATE'] = self.state
+
+        #
+        # - if $KONTROL_WARM includes "callback" send the request to our warm worker
+        # - the worker spills the large variables to temporary files on its own
+        # - fall back on a one-shot sub-process if the worker is not usable
+        #
+        env = dict(msg.env)
+        data.files = []
         try:
-            data.tick = time.time()
-            data.pid = Popen(msg.cmd.split(' '),
-            close_fds=True,
-            bufsize=0,
-            env=msg.env,
-            stderr=PIPE,
-            stdout=PIPE)
+            msg.running = True
+            data.child = None
+            if self.tag in str(self.cfg.get('warm', '')).split(',') and not getattr(msg, 'oneshot', False):
+                if not self.worker:
+                    self.worker = Worker(self.actor_ref, msg.cmd.split(' '), deadline=float(self.cfg.get('deadline', 60)), limit=int(self.cfg.get('buffer', LIMIT)), inline=int(self.cfg.get('inline', 65536)), sink=self.sink)
+
+                data.child = self.worker.submit(msg.cmd, env)
+
+            if not data.child:
+
+                #
+                # - any variable too large to be passed inline is written to a temporary file instead
+                # - the callback gets its path via the same variable suffixed by _FILE (e.g $PODS_FILE)
+                # - this keeps the environment small no matter how many pods we have
+                #
+                env, data.files = spill(env, int(self.cfg.get('inline', 65536)))
+                data.child = spawn(self.actor_ref, msg.cmd.split(' '),
+                close_fds=True,
+                bufsize=0,
+                env=env,
+                stderr=PIPE,
+                stdout=PIPE,
+                limit=int(self.cfg.get('buffer', LIMIT)),
+                overflow=self.cfg.get('overflow', 'spill'),
+                sink=self.sink)
        
         except OSError:
             logger.warning('%s : script "%s" could not be found (config bug ?)' % (self.path, msg.cmd))   
+            self._cleanup(data)
             self.fifo.popleft()
             return 'initial', data, 0.0
 
-        logger.debug('%s : invoking script "%s" (pid %s)' % (self.path, msg.cmd, data.pid.pid))
-        return 'wait_for_completion', data, 0.25
+        logger.debug('%s : invoking script "%s" (pid %s)' % (self.path, msg.cmd, data.child.pid))
+        return 'wait_for_completion', data, Park()
 
     def wait_for_completion(self, data):
 
         #
-        # - stop spinning once the process has exited
+        # - park until the reaper notifies us the process has exited
         # - both stderr and stdout are piped
         #
-        if data.pid.poll() is not None:
-            code = data.pid.returncode
-            stdout = [line.rstrip('\n') for line in iter(data.pid.stdout.readline, b'')]
-            stderr = [line.rstrip('\n') for line in iter(data.pid.stderr.readline, b'')]
-            lapse = time.time() - data.tick
-            logger.info('%s: callback took %2.1f s (pid %s, exit %d)' % (self.path, lapse, data.pid.pid, code))
-            if stderr:
-                logger.debug('%s : stderr (pid %s) -> \n  . %s' % (self.path, data.pid.pid, '\n  . '.join(stderr)))
+        out = data.child.done()
+        if out is not None and out.get('failed'):
+
+            #
+            # - our warm worker died, timed out or sent an answer that is too long
+            # - run that request again as a one-shot sub-process
+            # - unless the worker never reported ready : the callback did run in that case, drop the
+            #   request (nothing is committed)
+            #
+            if out.get('sent'):
+                logger.warning('%s : worker (pid %s) failed to answer, falling back to one-shot' % (self.path, data.child.pid))
+                self.fifo[0].oneshot = True
+            else:
+                logger.warning('%s : worker (pid %s) never reported ready, dropping the request' % (self.path, data.child.pid))
+                self.fifo.popleft()
+
+            data.child.close()
+            data.child = None
+            self._cleanup(data)
+            return 'initial', data, 0
+
+        if out is None and len(self.fifo) > 1 and self.cfg.get('preempt', False):
+
+            #
+            # - a newer request came in and we are allowed to preempt
+            # - kill the running callback and fold its request into the pending one (its changes
+            #   were not processed)
+            # - nothing is committed, go back to the initial state
+            #
+            logger.warning('%s : killing pid %s (newer request pending)' % (self.path, data.child.pid))
+            data.child.kill()
+            data.child.close()
+            data.child = None
+            self._cleanup(data)
+            self.fifo[1] = self._coalesce(self.fifo[0], self.fifo[1])
+            self.fifo.popleft()
+            return 'initial', data, 0
+
+        if out is not None:
+            msg = self.fifo[0]
+            pid = data.child.pid
+            stdout = data.child.stdout.lines(int(self.cfg.get('spill', 16777216)))
+            logger.info('%s: callback took %2.1f s (pid %s, exit %s, cpu %2.2f s, rss %d kB)' % \
+                (self.path, out['lapse'], pid, out['code'], out['user'] + out['system'], out['rss']))
             
             #
-            # - attempt to parse stdout into a json object
+            # - persist stdout as the new user-data unless it did not change
+            # - never overwrite user-data we were not able to read
             #
-            try:
-                self.client.write('/kontrol/%s/state' % self.cfg['labels']['app'], ''.join(stdout))
-            except ValueError:
-                logger.warning('%s : unable to parse stdout into json (script error ?)' % self.path)
+            if msg.readonly:
+                logger.warning('%s : user-data unavailable, discarding the callback output' % self.path)
+            else:
+                self._store(''.join(stdout))
+
+            #
+            # - commit the metadata (including the digest) of the snapshot we just processed
+            # - the next leader will load it and skip the callback if nothing changed
+            #
+            if hasattr(msg, 'meta'):
+                self.client.write('/kontrol/%s/snapshot' % self.cfg['labels']['app'], json.dumps(msg.meta))
 
             #
             # - dequeue the FIFO
             # - go back to the initial state
             #
-            data.pid = None
+            data.child.close()
+            data.child = None
+            self._cleanup(data)
             self.fifo.popleft()
             return 'initial', data, 0
 
-        return 'wait_for_completion', data, 0.25
+        return 'wait_for_completion', data, Park()
     
 
     def specialized(self, msg):
@@ -122,9 +229,163 @@ class Actor(FSM):
 
             #
             # - buffer the incoming script in our fifo
-            # - we'll dequeue it upon the next spin
+            # - if a request is already pending (e.g not running yet) replace it
+            # - we'll dequeue it right away if we are parked
             #
-            self.fifo.append(msg)
+            if self.fifo and not getattr(self.fifo[-1], 'running', False):
+                logger.debug('%s : coalescing pending callback request' % self.path)
+                self.fifo[-1] = self._coalesce(self.fifo[-1], msg)
+            else:
+                self.fifo.append(msg)
+
+        elif req == 'event':
+
+            #
+            # - our state key changed (or the watch was lost)
+            # - unless this is our own write drop the cached user-data, it will be read again
+            #
+            if self.watcher and msg['tag'] == self.watcher.tag:
+                if msg['action'] == 'resync' or msg['index'] != self.index:
+                    logger.debug('%s : user-data changed (index %s), dropping cache' % (self.path, msg['index']))
+                    self.state = None
         else:
             super(Actor, self).specialized(msg)
-        
\ No newline at end of file
+
+    def _coalesce(self, older, newer):
+
+        #
+        # - the newer request supersedes the older one
+        # - the changes and previous digest must however span both
+        # - if either one does not know what changed neither does the result
+        #
+        if hasattr(older, 'changes') and hasattr(newer, 'changes'):
+            newer.changes = merge(older.changes, newer.changes)
+        elif hasattr(newer, 'changes'):
+            del newer.changes
+
+        newer.env.pop('PREVIOUS', None)
+        if 'PREVIOUS' in older.env:
+            newer.env['PREVIOUS'] = older.env['PREVIOUS']
+
+        return newer
+
+    def _load(self):
+
+        #
+        # - read the user-data from etcd
+        # - the chunks of a chunked value may be gone if somebody replaced it in between, in which
+        #   case we read the key again
+        # - give up after a few attempts (e.g the chunks are corrupted) : the user-data is then left
+        #   untouched and we'll try again upon the next invocation
+        # - follow the key from there on so that we know when our copy gets stale
+        #
+        app = self.cfg['labels']['app']
+        for attempt in range(3):
+            try:
+                res = self.client.read('/kontrol/%s/state' % app)
+                raw = res.value or ''
+                index = res.modifiedIndex
+
+            except EtcdKeyNotFound as failure:
+                raw = ''
+                index = failure.payload['index'] if failure.payload and 'index' in failure.payload else 0
+
+            if raw.startswith(CHUNKED):
+                raw = self._unchunk(raw)
+                if raw is None:
+                    continue
+
+            self.state = raw
+            self.digest = hashlib.md5(raw).hexdigest()
+            self.index = index
+            self._watch()
+            return True
+
+        logger.error('%s : unable to read the user-data, leaving it as is' % self.path)
+        return False
+
+    def _unchunk(self, raw):
+
+        #
+        # - a chunked value is stored as a small manifest followed by compressed chunks
+        # - return None if the chunks are missing or don't match the manifest
+        #
+        app = self.cfg['labels']['app']
+        try:
+            js = json.loads(raw[len(CHUNKED):])
+            leaves = self.client.read('/kontrol/%s/chunks/%s' % (app, js['md5']), recursive=True).leaves
+            blob = ''.join(item.value for item in sorted(leaves, key=lambda item: item.key))
+            raw = zlib.decompress(base64.b64decode(blob))
+            if hashlib.md5(raw).hexdigest() == js['md5']:
+                return raw
+
+            logger.warning('%s : chunked user-data corrupted (digest mismatch)' % self.path)
+
+        except EtcdKeyNotFound:
+            logger.debug('%s : user-data chunks missing (replaced ?), reloading' % self.path)
+
+        except (KeyError, TypeError, ValueError, zlib.error) as failure:
+            logger.warning('%s : chunked user-data corrupted (%s)' % (self.path, failure))
+
+        return None
+
+    def _store(self, raw):
+
+        #
+        # - skip the write if the user-data did not change
+        # - values larger than $KONTROL_CHUNK bytes are compressed and written as chunks, followed by
+        #   the manifest which is what readers look at first
+        # - remove any other chunks (e.g from a previous value)
+        #
+        digest = hashlib.md5(raw).hexdigest()
+        if digest == self.digest and self.state is not None:
+            logger.debug('%s : user-data unchanged, skipping write' % self.path)
+            return
+
+        app = self.cfg['labels']['app']
+        size = int(self.cfg.get('chunk', 262144))
+        value = raw
+        if len(raw) > size:
+            blob = base64.b64encode(zlib.compress(raw))
+            chunks = [blob[n:n + size] for n in range(0, len(blob), size)]
+            for n, chunk in enumerate(chunks):
+                self.client.write('/kontrol/%s/chunks/%s/%06d' % (app, digest, n), chunk)
+
+            value = CHUNKED + json.dumps({'md5': digest, 'size': len(raw), 'chunks': len(chunks)})
+            logger.debug('%s : user-data stored as %d chunks (%d -> %d bytes)' % (self.path, len(chunks), len(raw), len(blob)))
+
+        self.index = self.client.write('/kontrol/%s/state' % app, value).modifiedIndex
+        self.state = raw
+        self.digest = digest
+        try:
+            for item in self.client.read('/kontrol/%s/chunks' % app).leaves:
+                if item.dir and item.key.rsplit('/', 1)[-1] != digest:
+                    self.client.delete(item.key, recursive=True)
+
+        except EtcdKeyNotFound:
+            pass
+
+        if not self.watcher:
+            self._watch()
+
+    def _watch(self):
+
+        if self.watcher:
+            self.watcher.stop()
+
+        self.generation += 1
+        self.watcher = Watcher(self.actor_ref, self.cfg['etcd'], '/kontrol/%s/state' % self.cfg['labels']['app'], self.index + 1, self.generation, recursive=False)
+        self.watcher.start()
+
+    def _cleanup(self, data):
+
+        #
+        # - remove whatever temporary file we passed to the callback
+        #
+        for path in getattr(data, 'files', []):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        data.files = []
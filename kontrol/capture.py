@@ -0,0 +1,206 @@
+import errno
+import fcntl
+import logging
+import os
+import select
+
+from collections import deque
+from tempfile import TemporaryFile
+from threading import Lock, Thread
+
+#: our ochopod logger
+logger = logging.getLogger('kontrol')
+
+"""
+    Bounded capture of sub-process pipes, drained concurrently while the process runs.
+"""
+
+#: default cap in bytes for the in-memory buffer
+LIMIT = 1048576
+
+#: how much we read from the pipe in one go
+CHUNK = 65536
+
+
+class Capture(Thread):
+    """
+    Thread draining one sub-process pipe as it is being written to. This prevents the process from
+    stalling once the pipe buffer is full. What is read is kept in memory up to a size limit, past
+    which the overflow policy kicks in:
+
+    - *truncate*: the oldest chunks are dropped and only the tail of the output is kept.
+    - *spill*: the whole output is moved to a temporary file on disk.
+
+    An optional sink is invoked with the pid, tag and line for each line as it arrives (e.g to stream it
+    to the logger). Lines longer than one chunk are split, unless *width* is set in which case lines are
+    kept whole up to that many bytes : longer lines are discarded and reported to the sink as None instead
+    (e.g when each line is a message that must not be cut).
+
+    The pipe is switched to non-blocking mode and waited on using select(). This keeps the thread from
+    freezing the hub when running green (e.g the eventlet monkey-patched select() yields instead).
+    """
+
+    def __init__(self, pipe, pid, tag, limit=LIMIT, overflow='spill', sink=None, width=None):
+        super(Capture, self).__init__()
+        assert overflow in ['truncate', 'spill'], 'invalid overflow policy "%s"' % overflow
+
+        self.buffer = deque()
+        self.daemon = True
+        self.dropped = 0
+        self.limit = limit
+        self.lock = Lock()
+        self.overflow = overflow
+        self.pid = pid
+        self.pipe = pipe
+        self.sink = sink
+        self.size = 0
+        self.spill = None
+        self.tag = tag
+        self.width = width
+
+    def text(self, limit=None):
+        """
+        Returns whatever was captured so far. If the output spilled to disk at most the last *limit* bytes
+        are read back (starting on a line boundary), which keeps a large output from being loaded in memory.
+
+        :type limit: int
+        :param limit: optional cap in bytes on what is read back from disk
+        :rtype: str
+        """
+        with self.lock:
+            if self.spill:
+                self.spill.flush()
+                skip = self.size - limit if limit is not None and self.size > limit else 0
+                self.spill.seek(skip)
+                out = self.spill.read()
+                self.spill.seek(0, os.SEEK_END)
+                if skip:
+                    logger.warning('pid %s : only reading back the last %d bytes of %s' % (self.pid, limit, self.tag))
+                    out = out[out.find('\n') + 1:]
+
+                return out
+
+            return ''.join(self.buffer)
+
+    def lines(self, limit=None):
+        """
+        Returns whatever was captured so far as a list of lines (see :meth:`text`).
+
+        :type limit: int
+        :param limit: optional cap in bytes on what is read back from disk
+        :rtype: list
+        """
+        return self.text(limit).splitlines()
+
+    def close(self):
+        """
+        Releases the temporary file if we spilled to disk.
+        """
+        with self.lock:
+            if self.spill:
+                self.spill.close()
+                self.spill = None
+
+    def run(self):
+
+        pending = ''
+        skipping = False
+        fd = self.pipe.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        try:
+            while 1:
+
+                #
+                # - wait for the pipe to be readable and read whatever is available (up to one chunk)
+                # - an empty read means EOF (e.g all the writers closed the pipe)
+                #
+                try:
+                    select.select([fd], [], [])
+                    chunk = os.read(fd, CHUNK)
+
+                except (OSError, select.error) as failure:
+                    if failure.args[0] in [errno.EAGAIN, errno.EINTR]:
+                        continue
+                    raise
+
+                if not chunk:
+                    break
+
+                self._append(chunk)
+                if self.sink:
+
+                    #
+                    # - forward complete lines to the sink
+                    # - flush whatever is pending if no line break shows up for too long
+                    # - unless we frame by width : drop the lines that are too long (up to their
+                    #   line break) and report them as None
+                    #
+                    pending += chunk
+                    lines = pending.split('\n')
+                    pending = lines.pop()
+                    overlong = False
+                    if self.width is None:
+                        if len(pending) > CHUNK:
+                            lines.append(pending)
+                            pending = ''
+
+                    else:
+                        if skipping:
+                            if lines:
+                                lines.pop(0)
+                                skipping = False
+                            else:
+                                pending = ''
+
+                        if len(pending) > self.width:
+                            overlong = skipping = True
+                            pending = ''
+
+                    for line in lines:
+                        self.sink(self.pid, self.tag, None if self.width is not None and len(line) > self.width else line)
+
+                    if overlong:
+                        self.sink(self.pid, self.tag, None)
+
+            if self.sink and pending:
+                self.sink(self.pid, self.tag, pending)
+
+        except (IOError, OSError, select.error):
+            pass
+
+        finally:
+            self.pipe.close()
+
+        if self.dropped:
+            logger.warning('pid %s : %s capture truncated (%d bytes dropped)' % (self.pid, self.tag, self.dropped))
+
+    def _append(self, chunk):
+
+        with self.lock:
+            self.size += len(chunk)
+            if self.spill:
+                self.spill.write(chunk)
+                return
+
+            self.buffer.append(chunk)
+            if self.size > self.limit:
+                if self.overflow == 'spill':
+
+                    #
+                    # - move everything to a temporary file
+                    # - from now on nothing is kept in memory
+                    #
+                    self.spill = TemporaryFile()
+                    self.spill.writelines(self.buffer)
+                    self.buffer.clear()
+
+                else:
+
+                    #
+                    # - drop the oldest chunks until we fit again
+                    # - always keep the latest chunk
+                    #
+                    while self.size > self.limit and len(self.buffer) > 1:
+                        head = self.buffer.popleft()
+                        self.size -= len(head)
+                        self.dropped += len(head)
@@ -0,0 +1,73 @@
+from collections import deque
+
+"""
+    Debounce policy deciding when the callback is due after a series of changes.
+"""
+
+
+class Debounce(object):
+    """
+    Trailing debounce with a hard upper bound. Each change pushes the deadline to the end of a quiet period
+    and the deadline never goes past a maximum wait counted from the first pending change. This way bursts
+    of changes are batched together while the time to callback stays bounded.
+
+    The quiet period optionally grows with the churn rate : each change observed over the recent window adds
+    some extra time to it (e.g to batch more aggressively during rolling deployments).
+    """
+
+    def __init__(self, quiet, wait, growth=0.0, window=60.0):
+        assert quiet >= 0 and growth >= 0, 'invalid debounce settings (cannot be negative)'
+
+        self.deadline = None
+        self.first = None
+        self.growth = growth
+        self.history = deque()
+        self.quiet = quiet
+        self.wait = max(wait, quiet)
+        self.window = window
+
+    def change(self, now):
+        """
+        Records a change and returns how long until the callback is due.
+
+        :type now: float
+        :param now: the current time
+        :rtype: float
+        """
+        self.history.append(now)
+        while self.history and self.history[0] < now - self.window:
+            self.history.popleft()
+
+        if self.first is None:
+            self.first = now
+
+        quiet = self.quiet + self.growth * (len(self.history) - 1)
+        self.deadline = min(now + quiet, self.first + self.wait)
+        return self.deadline - now
+
+    def due(self, now):
+        """
+        Returns True if a change is pending and its deadline is past.
+
+        :type now: float
+        :param now: the current time
+        :rtype: bool
+        """
+        return self.deadline is not None and now >= self.deadline
+
+    def lapse(self, now):
+        """
+        Returns how long until the deadline, or None if no change is pending.
+
+        :type now: float
+        :param now: the current time
+        :rtype: float
+        """
+        return max(self.deadline - now, 0.0) if self.deadline is not None else None
+
+    def reset(self):
+        """
+        Clears the pending change (e.g once the callback has been invoked). The churn history is kept.
+        """
+        self.deadline = None
+        self.first = None
@@ -5,12 +5,13 @@ import os
 import sys
 import urllib3
 
-from flask import Flask, request
+from flask import Flask, Response, request
 from logging import DEBUG
 from logging.config import fileConfig
-from kontrol.fsm import MSG, diagnostic, shutdown
+from kontrol.fsm import MSG, diagnostic, shutdown, timers
 from kontrol.script import Actor as Script
 from kontrol.callback import Actor as Callback
+from kontrol.fanout import Actor as Fanout
 from kontrol.keepalive import Actor as KeepAlive
 from kontrol.leader import Actor as Leader
 from kontrol.sequence import Actor as Sequence
@@ -36,12 +37,19 @@ def _ping():
     # - PUT /ping (e.g keepalive updates from supervised containers)
     # - post to the sequence actor (please note this of course will only
     #   work in master mode)
+    # - reply with the recommended pacing for the next keepalive, or with
+    #   nothing if the actor is too busy to tell (the pod will use its default)
+    # - don't wait too long for the actor : the pod gives up after 1 second
     #
     try:
         js = request.get_json(silent=True, force=True)
         logger.debug('PUT /ping <- keepalive from %s' % js['ip'] )
-        kontrol.actors['sequence'].tell({'request': 'update', 'state': js})
-        return '', 200
+        try:
+            pace = kontrol.actors['sequence'].ask({'request': 'update', 'state': js}, timeout=0.25)
+            return json.dumps(pace), 200
+
+        except Timeout:
+            return '', 200
 
     except Exception:
         return '', 500
@@ -53,6 +61,10 @@ def _script():
     #
     # - PUT /script (e.g script evaluation request from the controller)
     # - post it to the script actor (this will only work in slave mode)
+    # - the request is either detached ("async" set), streamed ("stream" set) or
+    #   synchronous (the default)
+    # - its output may be cached for "cache" seconds (e.g read-only probes)
+    # - the command may be run by a warm worker if "warm" is set (see script.py)
     #
     try:
         js = request.get_json(silent=True, force=True)
@@ -60,19 +72,136 @@ def _script():
         msg = MSG({'request': 'invoke'})
         msg.cmd = js['cmd']
         msg.env = {'INPUT': json.dumps(js)}
-        msg.latch = ThreadingFuture()     
+        msg.latch = ThreadingFuture()
+        msg.lock = js.get('lock')
+        msg.detached = bool(js.get('async'))
+        msg.streamed = bool(js.get('stream'))
+        msg.warm = bool(js.get('warm'))
+        msg.ttl = float(js.get('cache', 0))
 
         #
-        # - block on a latch and reply with whatever the shell script
+        # - reject right away with a 503 if the script actor queue is full
+        # - detached : reply right away with the job id (see GET /script/<id>)
+        # - streamed : relay the standard output lines as they are produced using
+        #   a chunked response
+        # - otherwise block on a latch and reply with whatever the shell script
         #   wrote to its standard output
         #
         logger.debug('PUT /script <- invoking "%s"' % msg.cmd)
-        kontrol.actors['script'].tell(msg)
+        if not kontrol.actors['script'].ask(msg, timeout=5):
+            return '', 503
+
+        if msg.detached:
+            return json.dumps({'id': msg.id}), 202
+
+        if msg.streamed:
+            return Response(msg.stream.follow(), mimetype='text/plain'), 200
+
         return msg.latch.get(timeout=60), 200
         
     except Exception as e:
         return '', 500
 
+
+@http.route('/script/<id>', methods=['GET'])
+def _job(id):
+
+    #
+    # - GET /script/<id> (e.g the controller polling a detached script)
+    # - long-poll : block until the job is done or until ?wait=<seconds> elapses
+    #   (defaults to 30 seconds, at most 60)
+    # - reply with a 202 if the job is still pending, a 404 if it is unknown or
+    #   expired
+    #
+    try:
+        msg = kontrol.actors['script'].ask({'request': 'job', 'id': id}, timeout=5)
+        if msg is None:
+            return '', 404
+
+        done = msg.stream.wait(min(float(request.args.get('wait', 30)), 60.0))
+        js = {'id': id, 'state': 'done' if done else ('running' if msg.started else 'queued')}
+        if done:
+            js['code'] = getattr(msg, 'code', None)
+            js['stdout'] = getattr(msg, 'stdout', '')
+
+        return json.dumps(js), 200 if done else 202
+
+    except Exception:
+        return '', 500
+
+
+@http.route('/script/<id>/stream', methods=['GET'])
+def _follow(id):
+
+    #
+    # - GET /script/<id>/stream (e.g the controller following a detached script)
+    # - relay its standard output lines, from the start, as they are produced
+    #   using a chunked response
+    #
+    try:
+        msg = kontrol.actors['script'].ask({'request': 'job', 'id': id}, timeout=5)
+        if msg is None:
+            return '', 404
+
+        return Response(msg.stream.follow(), mimetype='text/plain'), 200
+
+    except Exception:
+        return '', 500
+
+
+@http.route('/fanout', methods=['PUT'])
+def _fanout():
+
+    #
+    # - PUT /fanout (e.g the controller running a command across the pods)
+    # - post it to the fanout actor (this will only work in master mode)
+    # - reply with one line of json per pod as they answer, using a chunked response
+    #
+    try:
+        js = request.get_json(silent=True, force=True)
+        assert 'cmd' in js, 'invalid request, "cmd" missing'
+
+        msg = MSG({'request': 'invoke'})
+        msg.js = js
+        logger.debug('PUT /fanout <- invoking "%s"' % js['cmd'])
+        kontrol.actors['fanout'].ask(msg, timeout=5)
+        return Response(msg.stream.follow(), mimetype='text/plain'), 200
+
+    except Exception:
+        return '', 500
+
+
+@http.route('/stats', methods=['GET'])
+def _stats():
+
+    #
+    # - GET /stats (e.g runtime counters for troubleshooting)
+    # - report the shared timer heap figures (pending timers and firing lag)
+    # - in slave mode also report the script queue figures (queue wait and run time)
+    # - in master mode also report the lock lease figures (refresh latency and headroom)
+    # - skip whatever actor is too busy to answer (e.g partial stats are better than none)
+    #
+    try:
+        js = {'timers': timers().snapshot()}
+        if 'script' in kontrol.actors:
+            try:
+                js['script'] = kontrol.actors['script'].ask({'request': 'stats'}, timeout=1.0)
+            except Timeout:
+                pass
+
+        if 'leader' in kontrol.actors:
+            try:
+                heartbeat = kontrol.actors['leader'].ask({'request': 'get', 'key': 'heartbeat'}, timeout=1.0)
+                if heartbeat:
+                    js['lease'] = heartbeat.snapshot()
+            except Timeout:
+                pass
+
+        return json.dumps(js), 200
+
+    except Exception:
+        return '', 500
+
 def up():
     
     #
@@ -142,10 +271,10 @@ def up():
             stubs += [KeepAlive, Script]
         
         #
-        # - master mode requires the Callback, Leader and Sequence actors
+        # - master mode requires the Callback, Leader, Sequence and Fanout actors
         #
         if 'master' in tokens:
-            stubs += [Callback, Leader, Sequence]
+            stubs += [Callback, Leader, Sequence, Fanout]
 
         #
         # - start our various actors
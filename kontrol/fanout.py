@@ -0,0 +1,195 @@
+import etcd
+import json
+import kontrol
+import logging
+import requests
+import time
+
+from etcd import EtcdKeyNotFound
+from kontrol.capture import LIMIT
+from kontrol.fsm import Aborted, FSM, Park, diagnostic
+from kontrol.pool import Pool
+from kontrol.stream import Stream
+from pykka import Timeout
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout
+from urllib3.exceptions import NewConnectionError
+
+
+#: our ochopod logger
+logger = logging.getLogger('kontrol')
+
+
+class Actor(FSM):
+
+    """
+    Actor in charge of running a command across the pod ensemble on behalf of the
+    controller. Each selected pod is sent a PUT /script request and the requests
+    are issued concurrently by a pool of $KONTROL_FANOUT threads sharing the same
+    HTTP connections. Each pod outcome is appended to the request stream (one line
+    of json) as soon as it comes back.
+
+    Pods are picked from the leader snapshot if we are leading, or read from etcd
+    otherwise.
+    """
+
+    tag = 'fanout'
+
+    #: how many pods we keep HTTP connections to
+    hosts = 512
+
+    def __init__(self, cfg):
+        super(Actor, self).__init__()
+
+        size = int(cfg.get('fanout', 32))
+        self.cfg = cfg
+        self.client = etcd.Client(host=cfg['etcd'], port=2379)
+        self.inflight = {}
+        self.path = '%s actor' % self.tag
+        self.pool = Pool(size)
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=self.hosts, pool_maxsize=size))
+
+    def reset(self, data):
+
+        if self.terminate:
+            self.pool.shutdown()
+            super(Actor, self).reset(data)
+
+        return 'initial', data, 0.0
+
+    def initial(self, data):
+
+        if self.terminate and not self.inflight:
+            raise Aborted('resetting')
+
+        #
+        # - just park, the work is done by our pool workers
+        #
+        return 'initial', data, Park()
+
+    def specialized(self, msg):
+        assert 'request' in msg, 'bogus message received ?'
+        req = msg['request']
+        if req == 'invoke':
+
+            #
+            # - grab the pods matching the request selectors
+            # - return how many pods are targeted (the stream is closed right away if none)
+            # - size the stream so that it can hold the whole output of each pod
+            # - submit one job per pod to our pool
+            #
+            pods = self._select(msg.js)
+            msg.pending = len(pods)
+            msg.stream = Stream(max(len(pods), 1) * int(self.cfg.get('buffer', LIMIT)))
+            msg.tick = time.time()
+            if not pods:
+                msg.stream.close()
+                return 0
+
+            self.inflight[id(msg)] = msg
+            for pod in pods:
+                self.pool.submit(self._job, msg, pod)
+
+            logger.debug('%s : invoking "%s" on %d pods' % (self.path, msg.js['cmd'], len(pods)))
+            return len(pods)
+
+        elif req == 'done':
+
+            #
+            # - one of our workers is done with its pod
+            # - close the stream once all the pods answered
+            #
+            msg = self.inflight[msg['id']]
+            msg.pending -= 1
+            if not msg.pending:
+                del self.inflight[id(msg)]
+                msg.stream.close()
+                logger.debug('%s : "%s" done in %2.1f s' % (self.path, msg.js['cmd'], time.time() - msg.tick))
+
+        else:
+            return super(Actor, self).specialized(msg)
+
+    def _select(self, js):
+
+        #
+        # - use the leader snapshot if we are leading (no need to hit etcd)
+        # - otherwise read the pods directory
+        #
+        pods = None
+        if 'leader' in kontrol.actors:
+            try:
+                pods = kontrol.actors['leader'].ask({'request': 'pods'}, timeout=1.0)
+            except Timeout:
+                pass
+
+        if pods is None:
+            try:
+                raw = self.client.read('/kontrol/%s/pods' % self.cfg['labels']['app'], recursive=True)
+                pods = sorted((json.loads(item.value) for item in raw.leaves if item.value), key=lambda pod: pod['seq'])
+
+            except EtcdKeyNotFound:
+                pods = []
+
+        #
+        # - "keys" restricts to a list of pod keys
+        # - "select" restricts to the pods whose fields match (e.g {"role": "broker"})
+        #
+        keys = set(js['keys']) if 'keys' in js else None
+        select = js.get('select', {})
+        return [pod for pod in pods if (keys is None or pod['key'] in keys) and all(pod.get(k) == v for k, v in select.items())]
+
+    def _job(self, msg, pod):
+
+        #
+        # - please note this is run from one of our pool workers
+        # - forward the request body to the pod (minus what only makes sense to us)
+        # - the pod may reject the request if its queue is full (503) or refuse the connection for a
+        #   bit : retry a few times with exponential backoff (the command did not run in either case)
+        # - anything else (including a timeout or a connection dropped while we were waiting for the
+        #   response) is final since the command may have run
+        # - make sure to always notify the actor, even upon failure
+        #
+        out = {'key': pod['key'], 'seq': pod['seq'], 'ip': pod['ip']}
+        tick = time.time()
+        try:
+            js = {key: value for key, value in msg.js.items() if key not in ['async', 'keys', 'retries', 'select', 'stream', 'timeout']}
+            url = 'http://%s:8000/script' % pod['ip']
+            retries = int(msg.js.get('retries', 2))
+            timeout = float(msg.js.get('timeout', 60))
+            for attempt in range(retries + 1):
+                out['attempts'] = attempt + 1
+                try:
+                    resp = self.session.put(url, data=json.dumps(js), headers={'Content-Type': 'application/json'}, timeout=(1.0, timeout))
+                    if resp.status_code != 503 or attempt == retries:
+                        out['code'] = resp.status_code
+                        out['stdout'] = resp.text
+                        break
+
+                except ConnectionError as failure:
+                    if attempt == retries or not _unsent(failure):
+                        raise
+
+                time.sleep(0.25 * 2 ** attempt)
+
+        except Exception as failure:
+            out['error'] = diagnostic(failure)
+            logger.debug('%s : PUT /script failed on %s (%s)' % (self.path, pod['ip'], out['error']))
+
+        finally:
+            out['lapse'] = time.time() - tick
+            msg.stream.extend([json.dumps(out)])
+            self.actor_ref.tell({'request': 'done', 'id': id(msg)})
+
+
+def _unsent(failure):
+
+    #
+    # - tell whether a connection failure happened before the request was sent (e.g we could not
+    #   connect to the pod in time or it refused the connection)
+    #
+    if isinstance(failure, ConnectTimeout):
+        return True
+
+    reason = getattr(failure.args[0], 'reason', None) if failure.args else None
+    return isinstance(reason, NewConnectionError)
@@ -1,4 +1,5 @@
 import copy
+import heapq
 import logging
 import sys
 import time
@@ -7,7 +8,7 @@ import traceback
 from pykka import ThreadingActor, ThreadingFuture, Timeout
 from pykka.exceptions import ActorDeadError
 from random import randint
-from threading import Event, Thread
+from threading import Condition, Event, Lock, Thread
 
 #: our pycse logger
 logger = logging.getLogger('kontrol')
@@ -147,6 +148,39 @@ def diagnostic(failure):
     return '%s (%d) -> %s%s' % (where, line, type(failure).__name__, why)
 
 
+class Lapse(object):
+    """
+    Accumulator tracking a series of durations (e.g latencies) and summarizing them as their last, maximum and
+    mean values. Please note this is not thread-safe.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.last = 0.0
+        self.max = 0.0
+        self.total = 0.0
+
+    def record(self, lapse):
+        """
+        Accounts for one more duration.
+
+        :type lapse: float
+        :param lapse: the duration in seconds
+        """
+        self.count += 1
+        self.last = lapse
+        self.max = max(lapse, self.max)
+        self.total += lapse
+
+    def summary(self):
+        """
+        Returns the last, maximum and mean durations.
+
+        :rtype: dict
+        """
+        return {'last': self.last, 'max': self.max, 'mean': self.total / self.count if self.count else 0.0}
+
+
 class Retry(Exception):
     """
     Exception thrown to trip the machine back to the same state after an optional pause.
@@ -176,6 +210,17 @@ class Aborted(Exception):
         return str(self.log[-1])
 
 
+class Park(object):
+    """
+    Delay placeholder a state can return to park the machine until the next incoming message is processed
+    by specialized(). An optional timeout will resume the machine anyway once elapsed.
+    """
+
+    def __init__(self, timeout=None):
+        assert timeout is None or timeout >= 0, 'invalid timeout (cannot be negative)'
+        self.timeout = timeout
+
+
 class MSG(dict):
     """
     Placeholder we pass across states in the fsm (e.g that *data* parameter) with some extra attributes.
@@ -193,7 +238,9 @@ class FSM(ThreadingActor):
         super(FSM, self).__init__()
 
         self.dying = 0
+        self.epoch = 0
         self.latches = []
+        self.parked = None
         self.path = '?'
         self.payload = MSG(copy.deepcopy(payload) if payload else {})
         self.terminate = 0
@@ -273,11 +320,10 @@ class FSM(ThreadingActor):
 
         if delay > 0:
             #
-            # - run an ancillary thread that will sleep and then fire the message
+            # - register the message with the shared timer heap which will fire it later
             # - the machine itself won't block and will be able to process incoming messages
             #
-            scheduled = _Scheduled(self.actor_ref, payload, delay)
-            scheduled.start()
+            timers().schedule(self.actor_ref, payload, delay)
 
         else:
             #
@@ -285,6 +331,30 @@ class FSM(ThreadingActor):
             #
             self.actor_ref.tell(payload)
 
+    def park(self, payload, timeout=None):
+
+        #
+        # - tag the payload with a new epoch and keep it around until the next message comes in
+        # - if a timeout is specified also schedule it (whichever comes first wins, the other one
+        #   will be discarded as stale)
+        #
+        self.epoch += 1
+        payload['fsm']['epoch'] = self.epoch
+        entry = timers().schedule(self.actor_ref, payload, timeout) if timeout is not None else None
+        self.parked = payload, entry
+
+    def resume(self):
+
+        #
+        # - fire the parked state right now if any
+        #
+        if self.parked:
+            payload, entry = self.parked
+            self.parked = None
+            if entry:
+                timers().discard(entry)
+            self.actor_ref.tell(payload)
+
     def on_start(self):
 
         #
@@ -298,18 +368,25 @@ class FSM(ThreadingActor):
         # - default processing handler for any incoming actor message
         #
         if 'fsm' not in msg:
+            out = None
             try:
                 
                 #
                 # - not our internal state-switch message : run the specialized handler
                 # - make sure to return its outcome so that we can reply to other actors
                 #
-                return self.specialized(msg)
+                out = self.specialized(msg)
 
             except Exception as failure:
                 logger.debug('%s : exception trapped while handling specialized messages (%s)' % (self.path, str(failure)))
                 pass
 
+            #
+            # - this message may be what the machine is parked on, wake it up
+            #
+            self.resume()
+            return out
+
         else:
             cmd = msg['fsm']
             try:
@@ -319,7 +396,19 @@ class FSM(ThreadingActor):
                     # - skip if we're shutting down
                     #
                     pass
+
+                elif 'epoch' in cmd and cmd['epoch'] != self.epoch:
+
+                    #
+                    # - stale parked state (e.g the timeout fired after a message resumed it or the
+                    #   other way around), skip
+                    #
+                    pass
                 else:
+                    if 'epoch' in cmd:
+                        self.epoch += 1
+                        self.parked = None
+
                     func = getattr(self, cmd['state'], None)
                     assert func, '<' + cmd['state'] + '> does not exist'
                     assert callable(func), '<' + cmd['state'] + '> must be a callable'
@@ -335,11 +424,15 @@ class FSM(ThreadingActor):
                                         'data': data
                                     }
                             }
-                        assert delay >= 0, 'the delay until the next state switch must be positive'
-                        self.fire(payload, delay)
+                        if isinstance(delay, Park):
+                            self.park(payload, delay.timeout)
+                        else:
+                            assert delay >= 0, 'the delay until the next state switch must be positive'
+                            self.fire(payload, delay)
 
             except PoisonPill:
 
+                timers().cancel(self.actor_ref)
                 _kill(self.actor_ref)
                 self.dying = 1
 
@@ -347,6 +440,15 @@ class FSM(ThreadingActor):
 
                 assert cmd['state'] != 'reset', 'retrying is not allowed from the reset state'
                 delay = failure.delay
+                if 'epoch' in cmd:
+
+                    #
+                    # - we were resumed from a parked state : drop the epoch tag otherwise the
+                    #   retry would be considered stale
+                    #
+                    cmd = dict((key, value) for key, value in cmd.items() if key != 'epoch')
+                    msg = {'fsm': cmd}
+
                 now = time.time()
 
                 if 'retried at' not in cmd:
@@ -380,6 +482,7 @@ class FSM(ThreadingActor):
                 if cmd['state'] == 'reset':
 
                     logger.debug('%s : exception trapped while resetting (%s)' % (self.path, str(failure)))
+                    timers().cancel(self.actor_ref)
                     _kill(self.actor_ref)
                     self.dying = 1
 
@@ -418,28 +521,136 @@ class FSM(ThreadingActor):
                     self.fire(payload, delay)
 
 
-class _Scheduled(Thread):
+class _Timers(Thread):
     """
-    Thread emulating a scheduled message (e.g posted to the state-machine after some delay.
+    Process-wide timer heap emulating scheduled messages (e.g posted to a state-machine after some delay). All
+    the machines share this one single thread instead of spawning a new one for each delayed message.
     """
 
-    def __init__(self, ref, msg, lapse):
-        super(_Scheduled, self).__init__()
+    def __init__(self):
+        super(_Timers, self).__init__()
+
+        self.daemon = True
+        self.heap = []
+        self.lock = Condition(Lock())
+        self.owners = {}
+        self.seq = 0
+        self.stats = \
+            {
+                'cancelled': 0,
+                'fired': 0,
+                'lag': Lapse()
+            }
+
+    def schedule(self, ref, msg, lapse):
         assert lapse >= 0, 'invalid duration (cannot be negative)'
-        self.ref = ref
-        self.msg = msg
-        self.lapse = lapse
+        with self.lock:
 
-    def run(self):
-        time.sleep(self.lapse)
-        try:
             #
-            # - the tell() can raise if ever the actor has been nuked in the meantime
-            # - this would typically happen if exitcode() was invoked
+            # - each entry is a [deadline, sequence, actor urn, actor ref, message] list
+            # - the sequence guarantees FIFO ordering for identical deadlines
+            # - track the entries per actor so that we can cancel them later on
+            # - wake the thread up in case this new deadline is the earliest one
             #
-            self.ref.tell(self.msg)
-        except Exception:
-            pass
+            self.seq += 1
+            entry = [time.time() + lapse, self.seq, ref.actor_urn, ref, msg]
+            heapq.heappush(self.heap, entry)
+            self.owners.setdefault(ref.actor_urn, set()).add(self.seq)
+            self.lock.notify()
+            return entry
+
+    def discard(self, entry):
+        with self.lock:
+
+            #
+            # - flag that one entry, it will be lazily discarded when popped from the heap
+            #
+            pending = self.owners.get(entry[2], set())
+            if entry[1] in pending:
+                pending.discard(entry[1])
+                entry[3] = None
+                if not pending:
+                    del self.owners[entry[2]]
+
+    def cancel(self, ref):
+        with self.lock:
+
+            #
+            # - flag whatever is pending for that actor
+            # - the entries are lazily discarded when popped from the heap
+            #
+            pending = self.owners.pop(ref.actor_urn, set())
+            for entry in self.heap:
+                if entry[1] in pending:
+                    entry[3] = None
+
+            self.stats['cancelled'] += len(pending)
+
+    def snapshot(self):
+        with self.lock:
+            return \
+                {
+                    'pending': sum(len(seqs) for seqs in self.owners.values()),
+                    'fired': self.stats['fired'],
+                    'cancelled': self.stats['cancelled'],
+                    'lag': self.stats['lag'].summary()
+                }
+
+    def run(self):
+        while 1:
+            with self.lock:
+
+                #
+                # - sleep until the earliest deadline (or until something new is scheduled)
+                # - pop the entry and measure how late we are
+                #
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.lock.wait(self.heap[0][0] - time.time() if self.heap else None)
+
+                deadline, seq, urn, ref, msg = heapq.heappop(self.heap)
+                if ref is None:
+                    continue
+
+                lag = max(0.0, time.time() - deadline)
+                pending = self.owners.get(urn)
+                if pending is not None:
+                    pending.discard(seq)
+                    if not pending:
+                        del self.owners[urn]
+
+                self.stats['fired'] += 1
+                self.stats['lag'].record(lag)
+
+            try:
+                #
+                # - the tell() can raise if ever the actor has been nuked in the meantime
+                # - this would typically happen if exitcode() was invoked
+                #
+                ref.tell(msg)
+            except Exception:
+                pass
+
+
+#: our shared timer heap (lazily started)
+_timers = None
+
+#: guards the lazy start of the timer heap
+_timers_lock = Lock()
+
+
+def timers():
+    """
+    Returns the process-wide timer heap, starting its thread if needed (for instance after a fork).
+
+    :rtype: :class:`_Timers`
+    """
+    global _timers
+    with _timers_lock:
+        if _timers is None or not _timers.is_alive():
+            _timers = _Timers()
+            _timers.start()
+
+        return _timers
 
 
 def _kill(actor_ref):
@@ -0,0 +1,140 @@
+import etcd
+import logging
+import time
+
+from etcd import EtcdKeyNotFound
+from kontrol.fsm import Lapse
+from pykka.exceptions import ActorDeadError
+from threading import Event, Lock, Thread
+
+#: our ochopod logger
+logger = logging.getLogger('kontrol')
+
+"""
+    Lease keeper refreshing a lock key independently of its owner.
+"""
+
+
+class Heartbeat(Thread):
+    """
+    Thread refreshing an etcd key TTL at a fixed period, regardless of what its owning state-machine is
+    busy doing. The lease expiry is tracked locally (conservatively, based on when each refresh was
+    issued). If the key is gone or if the refreshes keep failing until the lease is about to expire the
+    thread gives up, records why in *lost* and wakes the actor up with a *lease* message:
+
+    .. code-block:: python
+
+        {'request': 'lease', 'key': key}
+
+    The actor is then expected to step down.
+    """
+
+    def __init__(self, ref, host, key, ttl=10, period=1.0, margin=2.0):
+        super(Heartbeat, self).__init__()
+        assert period < ttl - margin, 'invalid heartbeat period (must leave room before the lease expires)'
+
+        #
+        # - use a dedicated client (so that we never queue behind the actor's requests)
+        # - bound each request to half the margin so that a hung refresh can't prevent us from giving
+        #   up before the lease expires
+        #
+        self.client = etcd.Client(host=host, port=2379, read_timeout=margin / 2.0)
+        self.daemon = True
+        self.expiry = time.time() + ttl
+        self.key = key
+        self.lock = Lock()
+        self.lost = None
+        self.margin = margin
+        self.period = period
+        self.ref = ref
+        self.stopped = Event()
+        self.ttl = ttl
+        self.stats = \
+            {
+                'refreshed': 0,
+                'failed': 0,
+                'headroom': float(ttl),
+                'latency': Lapse()
+            }
+
+    def remaining(self):
+        """
+        Returns how many seconds are left on the lease.
+
+        :rtype: float
+        """
+        with self.lock:
+            return self.expiry - time.time()
+
+    def stop(self):
+        """
+        Requests the thread to exit.
+        """
+        self.stopped.set()
+
+    def snapshot(self):
+        with self.lock:
+            return \
+                {
+                    'key': self.key,
+                    'remaining': self.expiry - time.time(),
+                    'refreshed': self.stats['refreshed'],
+                    'failed': self.stats['failed'],
+                    'headroom': self.stats['headroom'],
+                    'latency': self.stats['latency'].summary()
+                }
+
+    def run(self):
+
+        lapse = self.period
+        try:
+            while not self.stopped.wait(lapse):
+                tick = time.time()
+                try:
+
+                    #
+                    # - refresh the TTL
+                    # - the lease is only extended from the time the request was issued
+                    # - keep track of the latency and of the smallest remaining lease we refreshed at
+                    #
+                    self.client.refresh(self.key, ttl=self.ttl)
+                    with self.lock:
+                        self.stats['refreshed'] += 1
+                        self.stats['headroom'] = min(self.stats['headroom'], self.expiry - tick)
+                        self.stats['latency'].record(time.time() - tick)
+                        self.expiry = tick + self.ttl
+
+                    lapse = self.period
+
+                except EtcdKeyNotFound:
+
+                    #
+                    # - the key is gone (e.g it expired or got deleted)
+                    #
+                    self._give_up('lost key %s (excessive lag ?)' % self.key)
+                    break
+
+                except Exception as failure:
+
+                    #
+                    # - connectivity issue or the like, retry faster
+                    # - step down before the lease expires if we can't get through
+                    #
+                    with self.lock:
+                        self.stats['failed'] += 1
+
+                    left = self.remaining()
+                    logger.debug('lease on %s : refresh failed (%s), %2.2f s left' % (self.key, failure, left))
+                    if left < self.margin:
+                        self._give_up('lease on %s about to expire (%2.2f s left)' % (self.key, left))
+                        break
+
+                    lapse = min(self.period, 0.25)
+
+        except ActorDeadError:
+            pass
+
+    def _give_up(self, why):
+
+        self.lost = why
+        self.ref.tell({'request': 'lease', 'key': self.key})
@@ -1,41 +1,62 @@
 import json
 import logging
+import random
 import requests
 import string
 import struct
 import time
 
-from kontrol.fsm import Aborted, FSM
+from kontrol.fsm import Aborted, FSM, Park
+from kontrol.monitor import Monitor
 from math import floor
 from os.path import isfile
+from requests.adapters import HTTPAdapter
 from socket import inet_aton
 
 
 #: our ochopod logger
 logger = logging.getLogger('kontrol')
 
-print 'fo'
 class Actor(FSM):
 
     """
     Actor emitting a periodic HTTP POST request against the controlling party. This enables us
     to report relevant information about the pod. The pod UUID is derived from its IPv4 address
-    and launch time shortened via base 62 encoding.
+    and launch time shortened via base 62 encoding. The same HTTP connection is re-used across
+    requests and the masters tell us when to send the next one.
+
+    The $KONTROL_PAYLOAD file is monitored and only parsed when it changes, in which case a
+    keepalive is sent right away (at most once per throttle period).
     """
 
     tag = 'keepalive'
 
+    #: minimum delay in seconds between two keepalives
+    throttle = 1.0
+
     def __init__(self, cfg):
         super(Actor, self).__init__()
 
         self.cfg = cfg
+        self.dirty = True
+        self.due = 0
+        self.last = 0
+        self.monitor = None
         self.path = '%s actor' % self.tag
+        self.parsed = {}
+        self.urgent = False
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
         self.key = self._shorten(struct.unpack("!I", inet_aton(cfg['ip']))[0])
         logger.info('%s : now using key %s (pod %s)' % (self.path, self.key, cfg['id']))
 
     def reset(self, data):
 
         if self.terminate:
+            if self.monitor:
+                self.monitor.stop()
+
+            self.session.close()
             super(Actor, self).reset(data)
 
         return 'initial', data, 0.0
@@ -45,6 +66,36 @@ class Actor(FSM):
         if self.terminate:
             raise Aborted('resetting')
 
+        #
+        # - $KONTROL_PAYLOAD is optional and can be set to point to a file
+        #   on disk that contains json user-data (for instance some statistics)
+        # - this free-form payload will be included in the keepalive HTTP PUT,
+        #   persisted in etcd and made available to the callback script
+        # - the file is monitored and only re-parsed when it changes
+        # - if the payload changed send a keepalive right away (throttled)
+        #
+        if 'payload' in self.cfg:
+            if not self.monitor:
+                self.monitor = Monitor(self.actor_ref, self.cfg['payload'])
+                self.monitor.start()
+
+            if self.dirty:
+                self.dirty = False
+                payload = self._load()
+                if payload != self.parsed:
+                    self.parsed = payload
+                    self.urgent = True
+
+        #
+        # - park until the next keepalive is due, or until the throttle period is
+        #   over if we have a payload update to report
+        # - the monitor will wake us up if the payload file changes
+        #
+        now = time.time()
+        nxt = min(self.due, self.last + self.throttle) if self.urgent else self.due
+        if now < nxt:
+            return 'initial', data, Park(nxt - now)
+
         #
         # - assemble the payload that will be reported periodically to the masters
         #   via the keepalive /PUT request
@@ -56,31 +107,12 @@ class Actor(FSM):
             'id': self.cfg['id'],
             'ip': self.cfg['ip'],
             'key': self.key,
-            'payload': {},
+            'payload': self.parsed,
             'role': self.cfg['labels']['role']
         }
 
         #
-        # - $KONTROL_PAYLOAD is optional and can be set to point to a file
-        #   on disk that contains json user-data (for instance some statistics)
-        # - this free-form payload will be included in the keepalive HTTP PUT,
-        #   persisted in etcd and made available to the callback script
-        #
-        # @todo monitor the payload file and force a keepalive upon update
-        #
-        if 'payload' in self.cfg:
-            try:
-                with open(self.cfg['payload'], 'r') as f:
-                    state['payload'] = json.loads(f.read())
-        
-            except IOError:
-                pass
-            except ValueError:
-                pass
-
-        #
-        # - simply HTTP PUT our cfg with a 1 second timeout
-        # - the ping frequency is once every TTL * 0.75 seconds
+        # - simply HTTP PUT our cfg with a 1 second timeout, re-using our connection
         # - please note any failure to post will be handled with exponential backoff by
         #   the state-machine
         #
@@ -88,10 +120,59 @@ class Actor(FSM):
         #
         ttl = int(self.cfg['ttl'])
         url = 'http://%s:8000/ping' % self.cfg['labels']['master']
-        resp = requests.put(url, data=json.dumps(state), headers={'Content-Type':'application/json'}, timeout=1.0)
+        resp = self.session.put(url, data=json.dumps(state), headers={'Content-Type':'application/json'}, timeout=1.0)
         resp.raise_for_status()
-        logger.debug('%s : HTTP %d <- PUT /ping %s' % (self.path, resp.status_code, url))            
-        return 'initial', data, ttl * 0.75
+        logger.debug('%s : HTTP %d <- PUT /ping %s' % (self.path, resp.status_code, url))
+
+        #
+        # - the master replies with when to ping next : wait for the recommended interval plus a
+        #   random delay up to the jitter (so that the pods spread out)
+        # - default to once every TTL * 0.75 seconds if it did not tell us
+        # - never wait longer than the TTL though
+        #
+        lapse = ttl * 0.75
+        try:
+            js = resp.json()
+            lapse = min(float(js['interval']) + random.uniform(0, float(js['jitter'])), ttl * 0.9)
+
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        self.due = now + lapse
+        self.last = now
+        self.urgent = False
+        return 'initial', data, Park(lapse)
+
+    def specialized(self, msg):
+        assert 'request' in msg, 'bogus message received ?'
+        req = msg['request']
+        if req == 'changed':
+
+            #
+            # - the payload file changed, we'll re-parse it upon waking up
+            #
+            self.dirty = True
+
+        else:
+            return super(Actor, self).specialized(msg)
+
+    def _load(self):
+
+        #
+        # - parse the payload file
+        # - default to an empty payload if the file is missing
+        # - keep the last valid payload if the file is invalid (e.g it is being written to)
+        #
+        try:
+            with open(self.cfg['payload'], 'r') as f:
+                return json.loads(f.read())
+
+        except IOError:
+            return {}
+
+        except ValueError:
+            logger.debug('%s : invalid json in %s, ignoring' % (self.path, self.cfg['payload']))
+            return self.parsed
 
     def _shorten(self, n):
 
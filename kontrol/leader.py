@@ -1,5 +1,4 @@
 import etcd
-import hashlib
 import json
 import kontrol
 import logging
@@ -7,7 +6,13 @@ import os
 import requests
 import time
 
-from kontrol.fsm import Aborted, FSM, MSG
+from collections import deque
+from etcd import EtcdKeyNotFound
+from kontrol.debounce import Debounce
+from kontrol.fsm import Aborted, FSM, MSG, Park
+from kontrol.heartbeat import Heartbeat
+from kontrol.snapshot import Snapshot
+from kontrol.watcher import Watcher
 
 
 #: our ochopod logger
@@ -26,19 +31,35 @@ class Actor(FSM):
 
         self.cfg = cfg
         self.client = etcd.Client(host=cfg['etcd'], port=2379)
+        self.dispatched = None
+        self.debounce = Debounce(float(cfg['damper']), float(cfg.get('wait', 30)), float(cfg.get('growth', 0.0)))
+        self.events = deque()
+        self.generation = 0
+        self.heartbeat = None
+        self.journaled = False
+        self.leading = False
         self.path = '%s actor' % self.tag
-        self.snapshot = {}
+        self.pods = Snapshot()
+        self.snapshot = []
         self.md5 = None
+        self.watcher = None
 
     def reset(self, data):
 
+        #
+        # - stop following the pods if we were leading
+        #
+        self.leading = False
+        self._unwatch()
+        self._unlease()
+
         if hasattr(data, 'lock'):
             try:
 
                 #
                 # - make sure to proactively delete the lock key
                 #
-                self.client.delete(data.lock.key)
+                self.client.delete(data.lock)
             except Exception:
                 pass
 
@@ -53,101 +74,275 @@ class Actor(FSM):
         # - setup our lock key which has a unique sequential id
         # - this key will live with a TTL of 10 seconds under locks/ and be prefixed by "leader-"
         #
-        data.trigger = 0
-        data.dirty = False
+        self.debounce.reset()
         data.lock = self.client.write('/kontrol/%s/locks/leader' % self.cfg['labels']['app'], '', append=True, ttl=10).key
         logger.debug('%s : created lock key #%d' % (self.path, int(data.lock[data.lock.rfind('/')+1:])))
+
+        #
+        # - keep the lock key alive from a dedicated thread, once per second
+        # - this way whatever we do (e.g processing a large snapshot) never delays the refresh
+        #
+        self.heartbeat = Heartbeat(self.actor_ref, self.cfg['etcd'], data.lock)
+        self.heartbeat.start()
         return 'acquire', data, 0.0
 
     def acquire(self, data):
-        
-        if self.terminate:
-            raise Aborted('resetting')
+
+        self._check()
 
         #
-        # - make sure we refresh our lock key
-        # - a failure means we lagged too much and the key timed out
+        # - check if the key we are watching went away
+        # - any other change (e.g a TTL refresh) is irrelevant
         #
-        try:
-            self.client.refresh(data.lock, ttl=10)
-        except EtcdKeyNotFound:
-            raise Aborted('lost key %s (excessive lag ?)' % data.lock.key)
+        lost = False
+        while self.events:
+            js = self.events.popleft()
+            lost |= js['action'] in ['resync', 'delete', 'expire', 'compareAndDelete']
+
+        if lost or not self.watcher:
+
+            #
+            # - query the lock directory
+            # - sort the keys and compare against ours
+            # - if we're first we own the lock
+            #
+            self._unwatch()
+            logger.debug('%s : attempting to grab lock' % self.path)
+            raw = self.client.read('/kontrol/%s/locks' % self.cfg['labels']['app'], recursive=True)
+            ordered = sorted(item.key for item in raw.leaves if not item.dir)
+            if data.lock not in ordered:
+                raise Aborted('lost key %s (excessive lag ?)' % data.lock)
+
+            n = ordered.index(data.lock)
+            if not n:
+                logger.info('%s : now acting as leader' % self.path)
+                self.leading = True
+                self._resume()
+                return 'sync', data, 0.0
+
+            #
+            # - otherwise only watch the key right before ours
+            # - we'll be woken up as soon as it goes away (whoever owns it either stepped down, died or
+            #   is now first in line)
+            #
+            self.generation += 1
+            self.watcher = Watcher(self.actor_ref, self.cfg['etcd'], ordered[n - 1], raw.etcd_index + 1, self.generation, recursive=False)
+            self.watcher.start()
+            logger.debug('%s : standing by, watching %s' % (self.path, ordered[n - 1]))
 
         #
-        # - query the lock directory
-        # - sort the keys and compare against ours
-        # - if we're first we own the lock
+        # - park until the watcher reports something (or until the heartbeat gives up)
         #
-        logger.debug('%s : attempting to grab lock' % self.path)
-        items = [item for item in self.client.read('/kontrol/%s/locks' % self.cfg['labels']['app'], recursive=True).leaves] 
-        ordered = sorted(item.key for item in items)        
-        if data.lock == ordered[0]:
-            logger.info('%s : now acting as leader' % self.path)
-            return 'watch', data, 0.0
+        return 'acquire', data, self._park()
 
-        return 'acquire', data, 5.0
+    def sync(self, data):
 
-    def watch(self, data):
+        self._check()
 
-        if self.terminate:
-            raise Aborted('resetting')
-        
         #
-        # - make sure we refresh our lock key
-        # - a failure means we lagged too much and the key timed out
+        # - grab the latest snapshot of our reporting pods with one single recursive read
+        # - the pods directory may not exist yet if nobody reported so far
+        # - keep the decoded pods around, keyed by their etcd key (only what changed since
+        #   we last looked will be decoded)
         #
+        self._unwatch()
+        path = '/kontrol/%s/pods' % self.cfg['labels']['app']
         try:
-            self.client.refresh(data.lock, ttl=10)
-        except EtcdKeyNotFound:
-            raise Aborted('lost key %s (excessive lag ?)' % data.lock.key)
+            raw = self.client.read(path, recursive=True)
+            index = raw.etcd_index
+            self.pods.reload(raw.leaves)
+
+        except EtcdKeyNotFound as failure:
+            index = failure.payload['index'] if failure.payload and 'index' in failure.payload else 0
+            self.pods.reload([])
 
         #
-        # - grab the latest snapshot of our reporting pods
-        # - order by the sequence index generated in state.py
-        # - compute the corresponding MD5 digest
-        # - compare against our last hash
+        # - follow any subsequent change via a watch starting right after the read index
+        # - the watcher will post back 'event' messages which will resume our watch state
         #
-        # @todo can we possibly use a watch and/or track indices?
+        self.events.clear()
+        self.generation += 1
+        self.watcher = Watcher(self.actor_ref, self.cfg['etcd'], path, index + 1, self.generation)
+        self.watcher.start()
+        data.changed = True
+        logger.debug('%s : %d pods read @ index %d, now watching' % (self.path, len(self.pods), index))
+        return 'watch', data, 0.0
+
+    def watch(self, data):
+
+        self._check()
+
         #
-        now = time.time()
-        hashed = hashlib.md5()
-        raw = self.client.read('/kontrol/%s/pods' % self.cfg['labels']['app'], recursive=True)
-        pods = [json.loads(item.value) for item in raw.leaves if item.value]
-        self.snapshot = sorted(pods, key=lambda pod: pod['seq'])
-        hashed.update(json.dumps(self.snapshot))
-        md5 = ':'.join(c.encode('hex') for c in hashed.digest())
-        
+        # - apply whatever changes the watcher reported so far
+        # - go back to the sync state if the watch was lost
         #
-        # - compare the new digest against the last one
-        # - if they differ trigger a callback after a cool-down period
+        while self.events:
+            js = self.events.popleft()
+            if js['action'] == 'resync':
+                logger.debug('%s : watch lost, resyncing' % self.path)
+                return 'sync', data, 0.0
+
+            elif js['action'] in ['delete', 'expire', 'compareAndDelete']:
+                data.changed |= self.pods.remove(js['key'])
+
+            elif js['value']:
+                data.changed |= self.pods.update(js['key'], js['index'], js['value'])
+
         #
-        if md5 != self.md5:
-            data.dirty = True
-            self.md5 = md5
-            damper = int(self.cfg['damper'])
-            data.trigger = now + damper
-            logger.debug('%s : change detected, script invokation in %d s' % (self.path, damper))
+        # - if anything changed get the MD5 digest of the pods ordered by the sequence index
+        #   generated in sequence.py (this is maintained incrementally)
+        # - compare against our last hash
+        #
+        now = time.time()
+        if data.changed:
+            data.changed = False
+            md5 = self.pods.md5()
+        
+            #
+            # - compare the new digest against the last one
+            # - if they differ trigger a callback once things settle down (see debounce.py)
+            #
+            if md5 != self.md5:
+                self.md5 = md5
+                self.snapshot = self.pods.pods()
+                lapse = self.debounce.change(now)
+                logger.debug('%s : change detected, script invokation in %2.1f s' % (self.path, lapse))
+
+        if self.debounce.due(now):
 
-        if data.dirty and now > data.trigger:
-                        
             #
-            # - reset the trigger
-            # - package the $PODS and $MD5 environment variables
+            # - make sure we still hold the lock before doing anything
+            # - reset the debounce
+            # - package the $PODS, $MD5 and $PREVIOUS environment variables
+            # - grab what changed since the last dispatch (unless we just took over and don't know
+            #   what the previous snapshot looked like)
             # - post to the update actor if $KONTROL_CALLBACK is defined
-            # - the $STATE variable will be added by the callback actor
+            # - the $STATE and $DIFF variables will be added by the callback actor
+            # - the digest is written to etcd right away, while the snapshot metadata (which holds it as
+            #   well) is committed once the callback is done
             #
-            data.dirty = False
-            logger.debug('%s : invoking callback, MD5 digest -> %s' % (self.path, md5))
-            self.client.write('/kontrol/%s/md5' % self.cfg['labels']['app'], md5)
+            self._check()
+            self.debounce.reset()
+            logger.debug('%s : invoking callback, MD5 digest -> %s' % (self.path, self.md5))
+            self.client.write('/kontrol/%s/md5' % self.cfg['labels']['app'], self.md5)
+            meta = {'md5': self.md5, 'pods': len(self.pods), 'time': time.time(), 'by': self.cfg.get('id')}
+            changes = self.pods.changes()
+            previous, journaled = self.dispatched, self.journaled
+            self.dispatched, self.journaled = self.md5, True
             if 'callback' in self.cfg:
 
                 msg = MSG({'request': 'invoke'})
                 msg.cmd = self.cfg['callback']
-                msg.env = {'MD5': md5, 'PODS': json.dumps(self.snapshot)}     
+                msg.env = {'MD5': self.md5, 'PODS': self.pods.dumps()}
+                msg.meta = meta
+                if previous:
+                    msg.env['PREVIOUS'] = previous
+                if journaled:
+                    msg.changes = changes
+
                 kontrol.actors['callback'].tell(msg)
          
             else:
                 logger.warning('%s: $KONTROL_CALLBACK is not set (user error ?)' % self.path)
-               
-        return 'watch', data, 1.0
+                self.client.write('/kontrol/%s/snapshot' % self.cfg['labels']['app'], json.dumps(meta))
+
+        #
+        # - park until the watcher reports something
+        # - wake up anyway when the callback is due
+        #
+        return 'watch', data, self._park(self.debounce.lapse(now))
+
+    def specialized(self, msg):
+        assert 'request' in msg, 'bogus message received ?'
+        req = msg['request']
+        if req == 'event':
+
+            #
+            # - buffer the changes reported by our current watcher
+            # - discard anything coming from a stale one
+            #
+            if self.watcher and msg['tag'] == self.watcher.tag:
+                self.events.append(msg)
+
+        elif req == 'lease':
+
+            #
+            # - the heartbeat gave up on our lock key
+            # - nothing to do, the machine will wake up and step down
+            #
+            pass
+
+        elif req == 'pods':
+
+            #
+            # - return the ordered list of pods if we are leading, None otherwise
+            #
+            return self.pods.pods() if self.leading else None
+
+        else:
+            return super(Actor, self).specialized(msg)
+
+    def _check(self):
+
+        #
+        # - abort if we're shutting down
+        # - step down if our lock key is gone or about to expire
+        #
+        if self.terminate:
+            raise Aborted('resetting')
+
+        if self.heartbeat.lost:
+            raise Aborted(self.heartbeat.lost)
+
+        left = self.heartbeat.remaining()
+        if left < self.heartbeat.margin:
+            raise Aborted('lease on %s about to expire (%2.2f s left)' % (self.heartbeat.key, left))
+
+    def _park(self, lapse=None):
+
+        #
+        # - never park past the point where we should step down
+        # - this way we still notice if the heartbeat is stuck refreshing the lease
+        #
+        left = max(self.heartbeat.remaining() - self.heartbeat.margin, 0.0)
+        return Park(left if lapse is None else min(lapse, left))
+
+    def _resume(self):
+
+        #
+        # - we just took over : load the last committed digest from the snapshot metadata
+        # - this way we won't invoke the callback unless the pods actually changed since then
+        # - please note /md5 is the last dispatched digest : the callback may not have completed
+        #
+        self.md5 = None
+        app = self.cfg['labels']['app']
+        try:
+            meta = json.loads(self.client.read('/kontrol/%s/snapshot' % app).value)
+            self.md5 = meta['md5']
+            logger.debug('%s : resuming from MD5 digest %s (%d pods, committed %d s ago by %s)' % \
+                (self.path, self.md5, meta['pods'], time.time() - meta['time'], meta['by']))
+
+        except (EtcdKeyNotFound, KeyError, TypeError, ValueError):
+            pass
+
+        #
+        # - start journaling the pod changes from now on
+        # - we can only diff against the committed snapshot if what we have in memory is that snapshot
+        #   (e.g we are taking over again and nothing happened in between)
+        #
+        self.pods.changes()
+        self.dispatched = self.md5
+        self.journaled = self.pods.md5() == self.md5 if self.md5 else not len(self.pods)
+
+    def _unlease(self):
+
+        if self.heartbeat:
+            self.heartbeat.stop()
+            self.heartbeat = None
+
+    def _unwatch(self):
 
+        self.events.clear()
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
@@ -0,0 +1,182 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+
+from pykka.exceptions import ActorDeadError
+from threading import Event, Thread
+
+#: our ochopod logger
+logger = logging.getLogger('kontrol')
+
+"""
+    File monitor notifying a state-machine whenever a file changes on disk.
+"""
+
+#: inotify flags (see linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+#: what we watch the parent directory for
+MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+#: inotify event header (wd, mask, cookie, name length)
+HEADER = struct.Struct('iIII')
+
+
+def _libc():
+
+    #
+    # - inotify is only available on linux
+    # - return None if we can't bind to it (in which case we'll poll)
+    #
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+
+    except (AttributeError, OSError):
+        return None
+
+
+class Monitor(Thread):
+    """
+    Thread tracking a file on disk (which may not exist yet) and telling the actor whenever it is created,
+    updated, replaced or deleted:
+
+    .. code-block:: python
+
+        {'request': 'changed', 'path': path}
+
+    Changes are detected by comparing the file modification time, size and inode. The parent directory is
+    watched using inotify (which catches atomic replacements via rename as well) and the thread only wakes
+    up upon activity in there. The file is also checked every *spin* seconds, or every *fallback* seconds if
+    inotify is not available. Please note the reference signature is taken upon construction (e.g whatever
+    happens afterwards will be reported).
+    """
+
+    def __init__(self, ref, path, spin=5.0, fallback=1.0):
+        super(Monitor, self).__init__()
+
+        self.daemon = True
+        self.fallback = fallback
+        self.fd = None
+        self.libc = _libc()
+        self.filename = os.path.basename(path)
+        self.path = path
+        self.ref = ref
+        self.signature = self._stat()
+        self.spin = spin
+        self.stopped = Event()
+        self.wd = None
+
+    def stop(self):
+        """
+        Requests the thread to exit (this will happen at most after one spin).
+        """
+        self.stopped.set()
+
+    def run(self):
+
+        try:
+            if self.libc:
+                fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+                if fd >= 0:
+                    self.fd = fd
+                else:
+                    logger.debug('inotify unavailable (%s), polling %s' % (os.strerror(ctypes.get_errno()), self.path))
+
+            while not self.stopped.is_set():
+
+                #
+                # - (re-)watch the parent directory if needed (e.g it did not exist yet or went away)
+                # - block until something happens in there or until the next spin
+                # - compare the file signature and notify the actor if it changed
+                #
+                self._watch()
+                self._wait()
+                latest = self._stat()
+                if latest != self.signature:
+                    self.signature = latest
+                    self.ref.tell({'request': 'changed', 'path': self.path})
+
+        except ActorDeadError:
+            pass
+
+        finally:
+            if self.fd is not None:
+                os.close(self.fd)
+
+    def _stat(self):
+
+        try:
+            st = os.stat(self.path)
+            return st.st_mtime, st.st_ctime, st.st_size, st.st_ino
+
+        except OSError:
+            return None
+
+    def _watch(self):
+
+        if self.fd is None or self.wd is not None:
+            return
+
+        wd = self.libc.inotify_add_watch(self.fd, os.path.dirname(os.path.abspath(self.path)), MASK)
+        if wd >= 0:
+            self.wd = wd
+
+    def _wait(self):
+
+        #
+        # - poll if we are not watching anything (no inotify or no parent directory yet)
+        #
+        if self.wd is None:
+            self.stopped.wait(self.fallback)
+            return
+
+        while not self.stopped.is_set():
+            try:
+                ready, _, _ = select.select([self.fd], [], [], self.spin)
+                if not ready:
+                    return
+
+                raw = os.read(self.fd, 65536)
+
+            except (OSError, select.error) as failure:
+                if failure.args[0] in [errno.EAGAIN, errno.EINTR]:
+                    continue
+                raise
+
+            #
+            # - go through the events and return if any is about our file
+            # - the watch is dropped by the kernel if the directory goes away (we'll re-add it later)
+            #
+            hit = False
+            offset = 0
+            while offset + HEADER.size <= len(raw):
+                wd, mask, _, size = HEADER.unpack_from(raw, offset)
+                name = raw[offset + HEADER.size:offset + HEADER.size + size].rstrip('\0')
+                offset += HEADER.size + size
+                if mask & IN_IGNORED and wd == self.wd:
+                    self.wd = None
+                    hit = True
+
+                elif name == self.filename or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    hit = True
+
+            if hit:
+                return
@@ -0,0 +1,72 @@
+from pykka import ThreadingFuture
+from Queue import Queue
+from threading import Thread
+
+"""
+    Bounded pool of worker threads.
+"""
+
+
+class Pool(object):
+    """
+    Fixed set of worker threads running jobs submitted from a state-machine. Each job gets a latch which is
+    set with whatever the job returned, or with the exception it raised (same convention as
+    :func:`kontrol.fsm.block`).
+    """
+
+    def __init__(self, size):
+        assert size > 0, 'invalid pool size (must be at least 1)'
+
+        self.queue = Queue()
+        self.size = size
+        self.workers = [_Worker(self.queue) for _ in range(size)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues a job for execution by one of the workers.
+
+        :type func: callable
+        :param func: the job to run, invoked with the specified arguments
+        :rtype: :class:`pykka.ThreadingFuture`
+        """
+        latch = ThreadingFuture()
+        self.queue.put((func, args, kwargs, latch))
+        return latch
+
+    def backlog(self):
+        """
+        Returns the number of queued jobs not picked up by a worker yet.
+
+        :rtype: int
+        """
+        return self.queue.qsize()
+
+    def shutdown(self):
+        """
+        Stops the workers once the jobs queued so far are done.
+        """
+        for _ in self.workers:
+            self.queue.put(None)
+
+
+class _Worker(Thread):
+
+    def __init__(self, queue):
+        super(_Worker, self).__init__()
+
+        self.daemon = True
+        self.queue = queue
+
+    def run(self):
+        while 1:
+            job = self.queue.get()
+            if job is None:
+                break
+
+            func, args, kwargs, latch = job
+            try:
+                latch.set(func(*args, **kwargs))
+            except Exception as failure:
+                latch.set(failure)
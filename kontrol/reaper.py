@@ -0,0 +1,219 @@
+import errno
+import logging
+import os
+import signal
+import time
+
+from kontrol.capture import Capture, LIMIT
+from pykka import ThreadingFuture, Timeout
+from pykka.exceptions import ActorDeadError
+from subprocess import Popen
+from tempfile import mkstemp
+from threading import Thread
+
+#: our ochopod logger
+logger = logging.getLogger('kontrol')
+
+"""
+    Child process reaper notifying the owning state-machine as soon as a sub-process exits.
+"""
+
+
+def spawn(ref, *args, **kwargs):
+    """
+    Starts a sub-process (the arguments are passed verbatim to :class:`subprocess.Popen`) and waits for it in
+    an ancillary thread. The owning actor is sent a *reaped* message the instant the process exits, which
+    will resume it if parked. The outcome (exit code, wall time and resource usage) is then available via
+    the returned handle.
+
+    Piped standard outputs are drained while the process runs using a :class:`kontrol.capture.Capture`. The
+    *limit*, *overflow*, *sink* and *width* keyword arguments are passed down to it.
+
+    :type ref: :class:`pykka.ActorRef`
+    :param ref: the actor to notify upon completion
+    :rtype: :class:`Child`
+    """
+    capture = \
+        {
+            'limit': kwargs.pop('limit', LIMIT),
+            'overflow': kwargs.pop('overflow', 'spill'),
+            'sink': kwargs.pop('sink', None),
+            'width': kwargs.pop('width', None)
+        }
+
+    child = Child(ref, Popen(*args, **kwargs), **capture)
+    child.start()
+    return child
+
+
+def spill(env, inline):
+    """
+    Writes any variable larger than *inline* bytes to a temporary file instead, its path being passed via the
+    same variable suffixed by _FILE (e.g $PODS_FILE). This keeps the environment (or a worker request) small
+    no matter how large the values get. The caller is expected to remove the files once done.
+
+    :type env: dict
+    :param env: the environment variables
+    :type inline: int
+    :param inline: the largest value in bytes passed as is
+    :rtype: (dict, list) tuple holding the new variables and the temporary file paths
+    """
+    out = dict(env)
+    files = []
+    for key in [key for key, value in env.items() if len(value) > inline]:
+        fd, path = mkstemp(prefix='kontrol-', suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            f.write(out.pop(key))
+
+        out['%s_FILE' % key] = path
+        files.append(path)
+
+    return out, files
+
+
+def stderr_sink(path):
+    """
+    Returns a capture sink (see :class:`kontrol.capture.Capture`) streaming the sub-process standard error
+    to our logger as it comes. Please note the sink is invoked from the capture thread.
+
+    :type path: str
+    :param path: the prefix to log with (e.g the actor path)
+    :rtype: callable
+    """
+    def _sink(pid, tag, line):
+        if tag == 'stderr':
+            logger.debug('%s : stderr (pid %s) -> %s' % (path, pid, line))
+
+    return _sink
+
+
+def _green():
+
+    #
+    # - if we run within a monkey-patched eventlet worker our threads are actually green threads
+    # - in that case we can't afford a blocking wait4() as this would freeze the whole hub
+    #
+    try:
+        from eventlet.patcher import is_monkey_patched
+        return is_monkey_patched('thread')
+    except ImportError:
+        return False
+
+
+class Child(Thread):
+    """
+    Thread blocking on a sub-process until it exits, packaging its outcome and notifying its owner. Its
+    piped standard outputs are captured as they are written to.
+    """
+
+    def __init__(self, ref, popen, **kwargs):
+        super(Child, self).__init__()
+
+        self.daemon = True
+        self.outcome = ThreadingFuture()
+        self.pid = popen.pid
+        self.popen = popen
+        self.ref = ref
+        self.tick = time.time()
+        self.stdout = Capture(popen.stdout, self.pid, 'stdout', **kwargs) if popen.stdout else None
+        self.stderr = Capture(popen.stderr, self.pid, 'stderr', **kwargs) if popen.stderr else None
+        for capture in [self.stdout, self.stderr]:
+            if capture:
+                capture.start()
+
+    def close(self):
+        """
+        Releases the capture resources.
+        """
+        for capture in [self.stdout, self.stderr]:
+            if capture:
+                capture.close()
+
+    def kill(self):
+        """
+        Kills the process (the outcome will be available once reaped). If the process leads its own process
+        group (e.g it was started with *preexec_fn=os.setsid*) the whole group is killed.
+        """
+        try:
+            if os.getpgid(self.pid) == self.pid:
+                os.killpg(self.pid, signal.SIGKILL)
+            else:
+                self.popen.kill()
+        except OSError:
+            pass
+
+    def done(self):
+        """
+        Returns the outcome if the process exited, None otherwise.
+
+        :rtype: dict
+        """
+        try:
+            return self.outcome.get(timeout=0)
+        except Timeout:
+            return None
+
+    def run(self):
+
+        code = None
+        usage = None
+        try:
+            #
+            # - wait4() gives us the exit status plus the resource usage for that specific pid
+            # - retry on EINTR
+            #
+            flags = os.WNOHANG if _green() else 0
+            spin = 0.001
+            while 1:
+                try:
+                    pid, status, usage = os.wait4(self.pid, flags)
+                    if pid:
+                        break
+
+                    #
+                    # - green mode : the process is still running, yield for a bit and retry
+                    #
+                    time.sleep(spin)
+                    spin = min(spin * 2, 0.05)
+
+                except OSError as failure:
+                    if failure.errno != errno.EINTR:
+                        raise
+
+            code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+            #
+            # - make sure the Popen object won't attempt to reap it again
+            #
+            self.popen.returncode = code
+
+        except OSError as failure:
+
+            #
+            # - ECHILD : someone else reaped the process
+            #
+            logger.debug('unable to reap pid %s (%s)' % (self.pid, failure))
+
+        #
+        # - give the captures a chance to read what is left in the pipes
+        # - don't wait forever though (a grandchild may still hold the pipe open)
+        #
+        lapse = time.time() - self.tick
+        for capture in [self.stdout, self.stderr]:
+            if capture:
+                capture.join(1.0)
+
+        js = \
+            {
+                'code': code,
+                'lapse': lapse,
+                'user': usage.ru_utime if usage else 0.0,
+                'system': usage.ru_stime if usage else 0.0,
+                'rss': usage.ru_maxrss if usage else 0
+            }
+
+        self.outcome.set(js)
+        try:
+            self.ref.tell({'request': 'reaped', 'pid': self.pid})
+        except ActorDeadError:
+            pass
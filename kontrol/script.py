@@ -1,11 +1,16 @@
+import hashlib
 import json
 import logging
 import time
 
-from collections import deque
-from kontrol.fsm import Aborted, FSM
-from subprocess import Popen, PIPE, STDOUT
-from threading import Event, Thread
+from collections import OrderedDict, deque
+from kontrol.capture import LIMIT
+from kontrol.fsm import Aborted, FSM, Lapse, Park
+from kontrol.reaper import spawn, stderr_sink
+from kontrol.stream import Stream
+from kontrol.worker import Job, Worker
+from subprocess import PIPE
+from uuid import uuid4
 
 #: our ochopod logger
 logger = logging.getLogger('kontrol')
@@ -18,6 +23,20 @@ class Actor(FSM):
     free to include free-form json data in its request. This json will be passed
     down as the $INPUT environment variable.
 
+    Up to $KONTROL_CONCURRENCY commands run at the same time. Requests are queued
+    in order (at most $KONTROL_QUEUE of them, past which they are rejected) and
+    commands sharing the same lock are serialized.
+
+    Each request gets a job id. Detached requests are tracked by id and their
+    outcome is kept around for $KONTROL_RETENTION seconds once done. The stdout
+    lines of detached or streamed requests are also buffered as they are produced
+    so that they can be followed.
+
+    Requests may opt in to result caching by specifying a TTL. Their output is then
+    cached (up to $KONTROL_CACHE bytes, least recently used first out) keyed by the
+    command and input, and identical requests coming in while one is pending share
+    its outcome instead of running again.
+
     @todo add some authentication mechanism to make sure the request is not forged
     #todo anything to do to secure/sandbox/limit what the controller can request ?
     """
@@ -27,79 +46,96 @@ class Actor(FSM):
     def __init__(self, cfg):
         super(Actor, self).__init__()
 
+        self.cache = OrderedDict()
+        self.cached = 0
         self.cfg = cfg
         self.fifo = deque()
+        self.flights = {}
+        self.jobs = OrderedDict()
         self.path = '%s actor' % self.tag
+        self.running = []
+        self.sink = stderr_sink(self.path)
+        self.workers = OrderedDict()
+        self.stats = \
+            {
+                'completed': 0,
+                'rejected': 0,
+                'hits': 0,
+                'misses': 0,
+                'shared': 0,
+                'wait': Lapse(),
+                'run': Lapse()
+            }
 
     def reset(self, data):
 
         if self.terminate:
+            for worker in self.workers.values():
+                worker.stop()
+
+            #
+            # - release whoever is following a pending job
+            #
+            for msg in list(self.fifo) + self.running:
+                for item in [msg] + msg.followers:
+                    if item.stream:
+                        item.stream.close()
+
             super(Actor, self).reset(data)
 
         return 'initial', data, 0.0
 
     def initial(self, data):
                 
-        if self.terminate and not self.fifo:
+        if self.terminate and not self.fifo and not self.running:
             raise Aborted('resetting')
 
         #
-        # - just spin if there is nothing to invoke
+        # - go through whatever is running and complete what is done
+        # - requests sent to a warm worker that died are queued again at the front
+        # - please note messages are dicts and may compare equal, hence no remove()
         #
-        if not self.fifo:
-            return 'initial', data, 0.25
+        now = time.time()
+        done = []
+        running = []
+        for msg in self.running:
+            (running if msg.child.done() is None else done).append(msg)
+
+        self.running = running
+        for msg in done:
+            self._complete(msg, now)
 
         #
-        # - set the popen call to use piping if required
-        # - spawn an ancillary thread to forward the lines to our logger
-        # - this thread will go down automatically when the sub-process does
+        # - start as many pending requests as $KONTROL_CONCURRENCY allows
+        # - requests are picked in order but skipped if their serialization keys are taken, either
+        #   by a running request or by an earlier pending one (the order is kept for a given key)
         #
-        msg = self.fifo[0]
-        data.latch = msg.latch
-        data.tick = time.time()
-        data.pid = Popen(msg.cmd,
-        close_fds=True,
-        shell=True,
-        bufsize=0,
-        env=msg.env,
-        stderr=PIPE,
-        stdout=PIPE)
+        limit = int(self.cfg.get('concurrency', 4))
+        pending = deque()
+        taken = set(key for msg in self.running for key in msg.keys)
+        for msg in self.fifo:
+            if len(self.running) < limit and taken.isdisjoint(msg.keys):
+                self._start(msg, now)
+                self.running.append(msg)
+            else:
+                pending.append(msg)
 
-        logger.debug('%s : invoking script "%s" (pid %s)' % (self.path, msg.cmd, data.pid.pid))
-        return 'wait_for_completion', data, 0.25
+            taken.update(msg.keys)
 
-    def wait_for_completion(self, data):
+        self.fifo = pending
 
         #
-        # - stop spinning once the process has exited
-        # - both stderr and stdout are piped
+        # - forget about the detached jobs that completed a while ago
         #
-        if data.pid.poll() is not None:
-            code = data.pid.returncode
-            stdout = [line.rstrip('\n') for line in iter(data.pid.stdout.readline, b'')]
-            stderr = [line.rstrip('\n') for line in iter(data.pid.stderr.readline, b'')]
-            lapse = time.time() - data.tick
-            logger.info('%s: script took %2.1f s (pid %s, exit %d)' % (self.path, lapse, data.pid.pid, code))
-            if stderr:
-                logger.debug('%s : stderr (pid %s) -> \n  . %s' % (self.path, data.pid.pid, '\n  . '.join(stderr)))
-
-            #
-            # - release the latch to unblock the HTTP request
-            #   handler
-            #  
-            data.latch.set('\n'.join(stdout))
-            Event()
+        retention = float(self.cfg.get('retention', 60))
+        for key in [key for key, msg in self.jobs.items() if msg.finished and now - msg.finished > retention]:
+            del self.jobs[key]
 
-            #
-            # - dequeue the FIFO
-            # - go back to the initial state
-            #
-            data.pid = None
-            self.fifo.popleft()
-            return 'initial', data, 0
-
-        return 'wait_for_completion', data, 0.25
-    
+        #
+        # - park until the next request comes in or until the reaper notifies us some
+        #   sub-process exited
+        #
+        return 'initial', data, Park()
 
     def specialized(self, msg):
         assert 'request' in msg, 'bogus message received ?'
@@ -107,10 +143,269 @@ class Actor(FSM):
         if req == 'invoke':
 
             #
-            # - buffer the incoming script in our fifo
-            # - we'll dequeue it upon the next spin
+            # - the request may specify a lock (commands sharing the same lock never run concurrently)
+            # - return whether the request was accepted or not
             #
+            now = time.time()
+            msg.digest = None
+            msg.finished = None
+            msg.followers = []
+            msg.id = uuid4().hex
+            msg.keys = [msg.lock] if getattr(msg, 'lock', None) else []
+            msg.started = None
+            msg.stream = None
+            msg.tick = now
+            if getattr(msg, 'detached', False) or getattr(msg, 'streamed', False):
+
+                #
+                # - only buffer the output lines if someone may follow them
+                #
+                msg.stream = Stream(int(self.cfg.get('buffer', LIMIT)))
+
+            if getattr(msg, 'ttl', 0) > 0:
+
+                #
+                # - the request opted in to caching
+                # - serve it from the cache if we have a fresh output
+                # - otherwise attach it to the identical request pending, if any
+                #
+                msg.digest = _digest(msg)
+                entry = self.cache.pop(msg.digest, None)
+                if entry and entry[0] > now:
+                    self.cache[msg.digest] = entry
+                    self.stats['hits'] += 1
+                    self._track(msg)
+                    self._finish(msg, 0, entry[1], now, replay=True)
+                    return True
+
+                if entry:
+                    self.cached -= entry[2]
+
+                if msg.digest in self.flights:
+                    self.stats['shared'] += 1
+                    self.flights[msg.digest].followers.append(msg)
+                    self._track(msg)
+                    return True
+
+            #
+            # - buffer the incoming script in our fifo, unless it is full
+            # - we'll dequeue it right away if we are parked
+            #
+            if len(self.fifo) >= int(self.cfg.get('queue', 64)):
+                self.stats['rejected'] += 1
+                return False
+
+            if msg.digest:
+                self.stats['misses'] += 1
+                self.flights[msg.digest] = msg
+
+            if self._warm(msg):
+
+                #
+                # - a warm worker only processes one request at a time
+                #
+                msg.keys.append('worker:%s' % msg.cmd)
+
             self.fifo.append(msg)
+            self._track(msg)
+            return True
+
+        elif req == 'job':
+
+            #
+            # - return the detached job matching the specified id (None if unknown or expired)
+            #
+            return self.jobs.get(msg['id'])
+
+        elif req == 'stats':
+
+            #
+            # - return our queue and timing figures
+            #
+            out = \
+                {
+                    'queued': len(self.fifo),
+                    'running': len(self.running),
+                    'completed': self.stats['completed'],
+                    'rejected': self.stats['rejected']
+                }
+
+            for key in ['wait', 'run']:
+                out[key] = self.stats[key].summary()
+
+            out['cache'] = \
+                {
+                    'hits': self.stats['hits'],
+                    'misses': self.stats['misses'],
+                    'shared': self.stats['shared'],
+                    'entries': len(self.cache),
+                    'bytes': self.cached
+                }
+
+            return out
+
         else:
-            super(Actor, self).specialized(msg)
-        
\ No newline at end of file
+            return super(Actor, self).specialized(msg)
+
+    def _track(self, msg):
+
+        #
+        # - keep track of detached requests by id
+        #
+        if getattr(msg, 'detached', False):
+            self.jobs[msg.id] = msg
+
+    def _warm(self, msg):
+
+        #
+        # - only commands explicitly flagged as workers are sent to a warm worker (anything else would
+        #   be started as a worker and possibly run twice)
+        #
+        if not getattr(msg, 'warm', False) or getattr(msg, 'oneshot', False):
+            return False
+
+        return self.tag in str(self.cfg.get('warm', '')).split(',')
+
+    def _start(self, msg, now):
+
+        #
+        # - set the popen call to use piping if required
+        # - spawn an ancillary thread to forward the lines to our logger and to the job stream
+        # - this thread will go down automatically when the sub-process does
+        # - if $KONTROL_WARM includes "script" and the request sets "warm" send it to a warm worker (one
+        #   per command, the least recently used one is stopped past 8 of them)
+        # - fall back on a one-shot sub-process if the worker is not usable
+        #
+        msg.child = None
+        msg.started = now
+        if self._warm(msg):
+            worker = self.workers.pop(msg.cmd, None) or Worker(self.actor_ref, msg.cmd, shell=True, deadline=float(self.cfg.get('deadline', 60)), limit=int(self.cfg.get('buffer', LIMIT)), inline=int(self.cfg.get('inline', 65536)), sink=self.sink)
+            self.workers[msg.cmd] = worker
+            if len(self.workers) > 8:
+                _, oldest = self.workers.popitem(last=False)
+                oldest.stop()
+
+            msg.child = worker.submit(msg.cmd, msg.env)
+
+        if not msg.child:
+
+            def _sink(pid, tag, line):
+                self.sink(pid, tag, line)
+                if msg.stream:
+                    msg.stream.sink(pid, tag, line)
+
+            msg.child = spawn(self.actor_ref, msg.cmd,
+            close_fds=True,
+            shell=True,
+            bufsize=0,
+            env=msg.env,
+            stderr=PIPE,
+            stdout=PIPE,
+            limit=int(self.cfg.get('buffer', LIMIT)),
+            overflow=self.cfg.get('overflow', 'spill'),
+            sink=_sink)
+
+        logger.debug('%s : invoking script "%s" (pid %s, queued %2.1f s)' % (self.path, msg.cmd, msg.child.pid, now - msg.tick))
+
+    def _complete(self, msg, now):
+
+        out = msg.child.done()
+        if out.get('failed') and out.get('sent'):
+
+            #
+            # - our warm worker died, timed out or sent an answer that is too long
+            # - run that request again as a one-shot sub-process
+            #
+            logger.warning('%s : worker (pid %s) failed to answer, falling back to one-shot' % (self.path, msg.child.pid))
+            msg.child.close()
+            msg.oneshot = True
+            self.fifo.appendleft(msg)
+            return
+
+        #
+        # - the worker never reported ready : fail the request (the command did run, we just don't
+        #   know what it did)
+        #
+        pid = msg.child.pid
+        stdout = [] if out.get('failed') else msg.child.stdout.lines(int(self.cfg.get('spill', 16777216)))
+        if out.get('failed'):
+            logger.warning('%s : worker (pid %s) never reported ready, failing the request' % (self.path, pid))
+
+        logger.info('%s: script took %2.1f s (pid %s, exit %s, cpu %2.2f s, rss %d kB)' % \
+            (self.path, out['lapse'], pid, out['code'], out['user'] + out['system'], out['rss']))
+
+        #
+        # - keep track of how long the request waited in the queue and how long it ran
+        #
+        self.stats['completed'] += 1
+        self.stats['wait'].record(msg.started - msg.tick)
+        self.stats['run'].record(now - msg.started)
+
+        #
+        # - warm workers answer in one go, pass their output to the job stream now
+        # - hand the same outcome to the identical requests that came in meanwhile
+        # - cache the output if the request opted in and the script succeeded
+        #
+        self._finish(msg, out['code'], stdout, now, replay=isinstance(msg.child, Job))
+        for item in msg.followers:
+            self._finish(item, out['code'], stdout, now, replay=True)
+
+        if msg.digest:
+            del self.flights[msg.digest]
+            if out['code'] == 0:
+                self._remember(msg.digest, now + msg.ttl, stdout)
+
+        msg.child.close()
+        msg.child = None
+
+    def _finish(self, msg, code, stdout, now, replay=False):
+
+        #
+        # - keep the outcome around for detached jobs
+        # - pass the output to the job stream if it was not streamed as it came
+        # - release the latch and close the stream to unblock the HTTP request
+        #   handlers
+        #
+        msg.code = code
+        msg.finished = now
+        msg.stdout = '\n'.join(stdout)
+        msg.latch.set(msg.stdout)
+        if msg.stream:
+            if replay:
+                msg.stream.extend(stdout)
+
+            msg.stream.close()
+
+    def _remember(self, digest, expiry, stdout):
+
+        #
+        # - cache the output lines until their expiry
+        # - evict the least recently used entries past $KONTROL_CACHE bytes
+        #
+        size = sum(len(line) + 1 for line in stdout)
+        limit = int(self.cfg.get('cache', 4194304))
+        if size > limit:
+            return
+
+        entry = self.cache.pop(digest, None)
+        if entry:
+            self.cached -= entry[2]
+
+        self.cache[digest] = (expiry, stdout, size)
+        self.cached += size
+        while self.cached > limit:
+            _, (_, _, evicted) = self.cache.popitem(last=False)
+            self.cached -= evicted
+
+
+def _digest(msg):
+
+    #
+    # - MD5 digest of a request command and input
+    # - leave out the fields that only tell us how to run it
+    #
+    js = json.loads(msg.env.get('INPUT', '{}'))
+    for key in ['async', 'cache', 'lock', 'stream', 'warm']:
+        js.pop(key, None)
+
+    return hashlib.md5('%s\n%s' % (msg.cmd, json.dumps(js, sort_keys=True))).hexdigest()
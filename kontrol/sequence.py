@@ -1,12 +1,15 @@
 import etcd
+import hashlib
 import json
 import logging
 import requests
 import time
 
-from collections import deque
-from etcd import EtcdAlreadyExist, EtcdKeyNotFound
-from kontrol.fsm import Aborted, FSM
+from collections import OrderedDict
+from etcd import EtcdAlreadyExist, EtcdCompareFailed, EtcdKeyNotFound
+from kontrol.fsm import Aborted, FSM, Park, diagnostic
+from kontrol.pool import Pool
+from threading import Lock
 
 
 #: our ochopod logger
@@ -32,57 +35,90 @@ class Actor(FSM):
     def __init__(self, cfg):
         super(Actor, self).__init__()
 
+        self.block = None
+        self.cache = {}
         self.cfg = cfg
         self.client = etcd.Client(host=cfg['etcd'], port=2379)
-        self.fifo = deque()
+        self.fifo = OrderedDict()
+        self.inflight = 0
+        self.lock = Lock()
         self.path = '%s actor' % self.tag
+        self.pool = Pool(int(cfg.get('workers', 8)))
 
     def reset(self, data):
 
         if self.terminate:
+            self.pool.shutdown()
             super(Actor, self).reset(data)
 
         return 'initial', data, 0.0
 
     def initial(self, data):
-                
-        if self.terminate and not self.fifo:
+
+        if self.terminate:
             raise Aborted('resetting')
 
-        while self.fifo:
+        #
+        # - warm our local cache up with one single recursive read
+        # - each pod etcd key maps to its sequence index, last payload digest, etcd index and
+        #   local expiry time
+        # - this is also done upon reset (e.g we can't trust what we cached anymore)
+        #
+        now = time.time()
+        ttl = int(self.cfg['ttl'])
+        self.cache = {}
+        try:
+            raw = self.client.read('/kontrol/%s/pods' % self.cfg['labels']['app'], recursive=True)
+            for item in raw.leaves:
+                if item.value:
+                    js = json.loads(item.value)
+                    self.cache[item.key] = [js['seq'], _digest(item.value), item.modifiedIndex, now + (item.ttl or ttl)]
 
-            #
-            # - lookup the key given the application label and the pod id
-            # - they etcd key is prefix by the master's application label
-            # - attempt to read its payload
-            #
-            now = time.time()
-            nxt = self.fifo[0]
-            path = '/kontrol/%s/pods/%s' % (self.cfg['labels']['app'], nxt['key'])
-            try:
-                js = json.loads(self.client.read(path).value)
-            
-            except EtcdKeyNotFound:
+        except EtcdKeyNotFound:
+            pass
 
-                #
-                # - if the read fails this is the first time that pod is reporting
-                # - in that case generate a new monotonic sequence index
-                # - attach it to the persisted pod payload
-                #
-                js = {'seq': self._next()}
+        data.swept = now
+        logger.debug('%s : %d pods cached' % (self.path, len(self.cache)))
+        return 'drain', data, 0.0
 
-            js.update(nxt)
+    def drain(self, data):
+                
+        if self.terminate and not self.fifo and not self.inflight:
+            raise Aborted('resetting')
 
-            #
-            # - make sure to sort the keys in the json being serialized to etcd
-            # - otherwise that could artifically change the MD5 digest
-            #
-            ttl = int(self.cfg['ttl'])
-            self.client.write(path, json.dumps(js, sort_keys=True), ttl=ttl)
-            logger.debug('%s : keepalive from %s (pod #%d)' % (self.path, js['key'], js['seq']))
-            self.fifo.popleft()
+        #
+        # - park until the next keepalive comes in or until the current batch is done
+        #
+        if not self.fifo or self.inflight:
+            return 'drain', data, Park()
 
-        return 'initial', data, 0.25
+        #
+        # - evict whatever expired from the cache (at most once per TTL)
+        # - this is safe to do now since none of our workers is busy
+        #
+        now = time.time()
+        ttl = int(self.cfg['ttl'])
+        if now - data.swept > ttl:
+            data.swept = now
+            for key in [key for key, entry in self.cache.items() if entry[3] < now]:
+                del self.cache[key]
+
+        #
+        # - drain the whole fifo as one batch (there is at most one pending payload per pod)
+        # - drop whatever is left of the index block reserved by the previous batch : a pod that
+        #   registered on another master since then would otherwise come after ours
+        # - run the etcd updates concurrently via our worker pool
+        # - each worker will notify us upon completion
+        #
+        batch = self.fifo.values()
+        self.block = None
+        self.fifo.clear()
+        self.inflight = len(batch)
+        for js in batch:
+            self.pool.submit(self._job, js)
+
+        logger.debug('%s : processing %d keepalives' % (self.path, len(batch)))
+        return 'drain', data, Park()
 
     def specialized(self, msg):
         assert 'request' in msg, 'bogus message received ?'
@@ -91,33 +127,155 @@ class Actor(FSM):
 
             #
             # - buffer the incoming payload in our fifo
-            # - we'll dequeue it upon the next spin
+            # - coalesce payloads coming from the same pod (the latest one wins)
+            # - we'll dequeue it right away if we are parked
+            # - return the pacing the pod should follow for its next keepalive
             #
             assert 'state' in msg, 'invalid message -> "%s" (bug ?)' % msg
-            self.fifo.append(msg['state'])
+            self.fifo[msg['state']['key']] = msg['state']
+            return self._pace()
+
+        elif req == 'done':
+
+            #
+            # - one of our workers is done with its keepalive
+            #
+            self.inflight -= 1
+
         else:
-            super(Actor, self).specialized(msg)
+            return super(Actor, self).specialized(msg)
+
+    def _pace(self):
+
+        #
+        # - recommend when the pod should send its next keepalive : wait for the interval plus a random
+        #   delay up to the jitter
+        # - nominally this averages to TTL * 0.75
+        # - the more keepalives are pending the more we slow the pods down (e.g after a mass restart), up
+        #   to TTL * 0.9 which is the most the pods will wait (see keepalive.py)
+        #
+        ttl = int(self.cfg['ttl'])
+        backlog = len(self.fifo) + self.inflight
+        pressure = min(backlog / (4.0 * self.pool.size), 1.0)
+        return {'interval': ttl * (0.7 + 0.1 * pressure), 'jitter': ttl * 0.1}
+
+    def _job(self, js):
+
+        #
+        # - please note this is run from one of our pool workers
+        # - make sure to always notify the actor, even upon failure
+        #
+        try:
+            self._update(js)
+
+        except Exception as failure:
+            logger.warning('%s : unable to process keepalive from %s (%s)' % (self.path, js['key'], diagnostic(failure)))
+
+        finally:
+            self.actor_ref.tell({'request': 'done'})
+
+    def _update(self, nxt):
+
+        #
+        # - lookup the key given the application label and the pod id
+        # - they etcd key is prefix by the master's application label
+        #
+        now = time.time()
+        ttl = int(self.cfg['ttl'])
+        path = '/kontrol/%s/pods/%s' % (self.cfg['labels']['app'], nxt['key'])
+        entry = self.cache.get(path)
+        if entry and entry[3] > now:
+
+            #
+            # - we already know this pod and its key did not expire yet
+            # - write directly, making sure nobody touched the key since we last did (for
+            #   instance another master)
+            # - if the payload did not change just refresh the TTL (this will not notify
+            #   the watchers nor rewrite the value)
+            # - if the compare fails or if the key is gone drop it from the cache and proceed
+            #   with a regular read
+            #
+            js = {'seq': entry[0]}
+            js.update(nxt)
+            value = json.dumps(js, sort_keys=True)
+            digest = _digest(value)
+            try:
+                if digest == entry[1]:
+                    res = self.client.refresh(path, ttl, prevIndex=entry[2])
+                else:
+                    res = self.client.write(path, value, ttl=ttl, prevIndex=entry[2])
+
+                self.cache[path] = [js['seq'], digest, res.modifiedIndex, now + ttl]
+                logger.debug('%s : keepalive from %s (pod #%d, %s)' % (self.path, js['key'], js['seq'], 'refreshed' if digest == entry[1] else 'cached'))
+                return
+
+            except (EtcdCompareFailed, EtcdKeyNotFound):
+                self.cache.pop(path, None)
+
+        #
+        # - attempt to read the pod payload
+        #
+        try:
+            js = json.loads(self.client.read(path).value)
+            
+        except EtcdKeyNotFound:
+
+            #
+            # - if the read fails this is the first time that pod is reporting
+            # - in that case generate a new monotonic sequence index
+            # - attach it to the persisted pod payload
+            #
+            js = {'seq': self._next()}
+
+        js.update(nxt)
+
+        #
+        # - make sure to sort the keys in the json being serialized to etcd
+        # - otherwise that could artifically change the MD5 digest
+        #
+        value = json.dumps(js, sort_keys=True)
+        res = self.client.write(path, value, ttl=ttl)
+        self.cache[path] = [js['seq'], _digest(value), res.modifiedIndex, now + ttl]
+        logger.debug('%s : keepalive from %s (pod #%d)' % (self.path, js['key'], js['seq']))
         
     def _next(self):
 
         #
         # - simple CAS incrementing a monotonic integer counter
         # - this counter is used as a sequence to order our pods in a deterministic way  
+        # - we reserve a whole block of indices at once and hand them out locally (this avoids
+        #   contention when lots of pods register at the same time)
+        # - blocks are only used within the batch that reserved them (see drain()) which means a
+        #   pod registering later on another master always gets a higher index
+        # - our workers serialize on a lock to avoid contending with each other
         #
         key = '/kontrol/%s/seq' % self.cfg['labels']['app']
+        with self.lock:
+            if self.block is None or self.block[0] > self.block[1]:
+                size = int(self.cfg.get('block', 16))
+                last = self._reserve(key, size)
+                self.block = [last - size + 1, last]
+                logger.debug('%s : reserved #%d to #%d' % (self.path, self.block[0], last))
+
+            nxt = self.block[0]
+            self.block[0] += 1
+            return nxt
+
+    def _reserve(self, key, size):
+
         while True:
             try:
 
                 cur = int(self.client.read(key).value)
-                nxt = int(self.client.write(key, cur + 1, prevValue=cur).value)
-                assert nxt == cur + 1, 'CAS failed (another party updated the counter)'
+                nxt = int(self.client.write(key, cur + size, prevValue=cur).value)
+                assert nxt == cur + size, 'CAS failed (another party updated the counter)'
                 logger.debug('%s : counter @ %d' % (self.path, nxt))
                 return nxt
 
-            except AssertionError:
+            except (AssertionError, EtcdCompareFailed):
                 
                 #
-                # - the CAS assert clause failed
+                # - the CAS failed
                 # - just ignore and spin
                 #
                 pass
@@ -133,4 +291,11 @@ class Actor(FSM):
                     self.client.write(key, -1, prevExist=False)
                 except EtcdAlreadyExist:
                     pass
-                
+
+
+def _digest(value):
+
+    #
+    # - MD5 digest of a serialized pod payload
+    #
+    return hashlib.md5(value).hexdigest()
@@ -0,0 +1,247 @@
+import hashlib
+import json
+
+from bisect import bisect_left, insort
+
+"""
+    Incrementally maintained snapshot of the pods reporting to the leader.
+"""
+
+
+class Snapshot(object):
+    """
+    Ordered set of pods keyed by their etcd key and sorted by sequence index. Each pod is decoded once per
+    etcd modification index and its serialized form is cached. The MD5 digest is maintained using hashing
+    checkpoints taken every few pods, so that a change only re-hashes what comes after it (new pods being
+    appended at the end this is usually very cheap).
+
+    The digest and serialized snapshot are byte-identical to what hashing *json.dumps()* of the ordered
+    list of pods produces.
+
+    Whatever is added, updated or removed is also journaled (recording what each pod looked like before
+    its first change) until :meth:`changes` is invoked.
+    """
+
+    #: number of pods between two hashing checkpoints
+    stride = 64
+
+    def __init__(self):
+
+        self.cached = None
+        self.entries = {}
+        self.journal = {}
+        self.order = []
+        self.states = []
+        self._rewind(0)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def update(self, key, index, value):
+        """
+        Adds or updates a pod given its etcd key, modification index and raw json value. Nothing is decoded
+        if the index did not change.
+
+        :type key: str
+        :param key: the pod etcd key
+        :type index: int
+        :param index: the etcd modification index
+        :type value: str
+        :param value: the serialized pod
+        :rtype: bool
+        """
+        entry = self.entries.get(key)
+        if entry and entry[0] == index:
+            return False
+
+        pod = json.loads(value)
+        raw = json.dumps(pod)
+        if entry and entry[3] == raw:
+
+            #
+            # - same content, new index (e.g the pod was re-written verbatim)
+            #
+            entry[0] = index
+            return False
+
+        if key not in self.journal:
+            self.journal[key] = entry[2] if entry else None
+
+        if entry:
+            self._drop(key, entry)
+
+        item = (pod['seq'], key)
+        insort(self.order, item)
+        self.entries[key] = [index, pod['seq'], pod, raw]
+        self._rewind(bisect_left(self.order, item))
+        return True
+
+    def remove(self, key):
+        """
+        Removes a pod given its etcd key.
+
+        :type key: str
+        :param key: the pod etcd key
+        :rtype: bool
+        """
+        entry = self.entries.pop(key, None)
+        if entry:
+            if key not in self.journal:
+                self.journal[key] = entry[2]
+
+            self._drop(key, entry)
+            return True
+
+        return False
+
+    def reload(self, leaves):
+        """
+        Reloads the whole snapshot from a list of etcd nodes (e.g a recursive read), re-using whatever was
+        already decoded if the modification index matches.
+
+        :type leaves: list
+        :param leaves: :class:`etcd.EtcdResult` nodes
+        :rtype: bool
+        """
+        changed = False
+        seen = set()
+        for item in leaves:
+            if item.value:
+                seen.add(item.key)
+                changed |= self.update(item.key, item.modifiedIndex, item.value)
+
+        for key in [key for key in self.entries if key not in seen]:
+            changed |= self.remove(key)
+
+        return changed
+
+    def pods(self):
+        """
+        Returns the ordered list of pods.
+
+        :rtype: list
+        """
+        return [self.entries[key][2] for _, key in self.order]
+
+    def changes(self):
+        """
+        Returns what changed since the last invocation as a dict mapping each etcd key to a (before, after)
+        tuple of pods (None meaning the pod did not exist). The journal is then cleared.
+
+        :rtype: dict
+        """
+        out = {}
+        for key, before in self.journal.items():
+            entry = self.entries.get(key)
+            after = entry[2] if entry else None
+            if before != after:
+                out[key] = (before, after)
+
+        self.journal = {}
+        return out
+
+    def dumps(self):
+        """
+        Returns the serialized ordered list of pods (same as json.dumps(self.pods())).
+
+        :rtype: str
+        """
+        return '[%s]' % ', '.join(self.entries[key][3] for _, key in self.order)
+
+    def md5(self):
+        """
+        Returns the MD5 digest of the serialized snapshot, as a colon separated hex string.
+
+        :rtype: str
+        """
+        if self.cached is None:
+
+            #
+            # - resume hashing from the last valid checkpoint
+            # - record new checkpoints as we go
+            #
+            start = (len(self.states) - 1) * self.stride
+            hashed = self.states[-1].copy()
+            for n in range(start, len(self.order)):
+                if n and n % self.stride == 0 and n // self.stride == len(self.states):
+                    self.states.append(hashed.copy())
+
+                raw = self.entries[self.order[n][1]][3]
+                hashed.update(', ' + raw if n else raw)
+
+            hashed.update(']')
+            self.cached = ':'.join(c.encode('hex') for c in hashed.digest())
+
+        return self.cached
+
+    def _drop(self, key, entry):
+
+        n = bisect_left(self.order, (entry[1], key))
+        del self.order[n]
+        self._rewind(n)
+
+    def _rewind(self, n):
+
+        #
+        # - invalidate the checkpoints past position n
+        # - the first checkpoint (just the opening bracket) is always valid
+        #
+        if not self.states:
+            hashed = hashlib.md5()
+            hashed.update('[')
+            self.states.append(hashed)
+
+        del self.states[n // self.stride + 1:]
+        self.cached = None
+
+
+def diff(changes):
+    """
+    Formats the changes returned by :meth:`Snapshot.changes` into lists of added, removed and changed pods,
+    each ordered by sequence index. Changed pods are reported with their key, sequence index and both their
+    previous and current content.
+
+    :type changes: dict
+    :param changes: (before, after) tuples keyed by etcd key
+    :rtype: dict
+    """
+    out = {'added': [], 'removed': [], 'changed': []}
+    for before, after in changes.values():
+        if before is None:
+            out['added'].append(after)
+        elif after is None:
+            out['removed'].append(before)
+        else:
+            out['changed'].append({'key': after['key'], 'seq': after['seq'], 'before': before, 'after': after})
+
+    for items in out.values():
+        items.sort(key=lambda item: item['seq'])
+
+    return out
+
+
+def merge(older, newer):
+    """
+    Combines two consecutive sets of changes (as returned by :meth:`Snapshot.changes`) into one, e.g what
+    changed between the start of the first one and the end of the second one.
+
+    :type older: dict
+    :param older: the first set of changes
+    :type newer: dict
+    :param newer: the set of changes that came right after
+    :rtype: dict
+    """
+    out = dict(older)
+    for key, (before, after) in newer.items():
+        if key in out:
+            before = out[key][0]
+
+        if before != after:
+            out[key] = (before, after)
+        else:
+            out.pop(key, None)
+
+    return out
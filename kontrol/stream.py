@@ -0,0 +1,122 @@
+import time
+
+from collections import deque
+from kontrol.capture import LIMIT
+from threading import Condition
+
+"""
+    Line buffer shared between a sub-process and the HTTP handlers following its output.
+"""
+
+
+class Stream(object):
+    """
+    Bounded buffer receiving the standard output lines of a sub-process as they are produced. Any number of
+    readers can follow it concurrently, each one tracking its own position (e.g the index of the next line
+    to read). Past *limit* bytes the oldest lines are dropped and readers lagging behind skip them.
+
+    The buffer is closed once the sub-process is done, at which point readers drain what is left and stop.
+    """
+
+    def __init__(self, limit=LIMIT):
+
+        self.closed = False
+        self.condition = Condition()
+        self.dropped = 0
+        self.limit = limit
+        self.lines = deque()
+        self.size = 0
+
+    def sink(self, pid, tag, line):
+        """
+        Capture sink (see :class:`kontrol.capture.Capture`) buffering the standard output lines.
+        """
+        if tag == 'stdout':
+            self.extend([line])
+
+    def extend(self, lines):
+        """
+        Appends lines and wakes the readers up.
+
+        :type lines: list
+        :param lines: the lines to append (without their line break)
+        """
+        with self.condition:
+            for line in lines:
+                self.lines.append(line)
+                self.size += len(line) + 1
+
+            while self.size > self.limit and len(self.lines) > 1:
+                self.size -= len(self.lines.popleft()) + 1
+                self.dropped += 1
+
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        Marks the buffer as complete and wakes the readers up.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def wait(self, timeout):
+        """
+        Blocks until the buffer is closed or until the timeout elapses.
+
+        :type timeout: float
+        :param timeout: how long to wait for in seconds
+        :rtype: bool
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while not self.closed:
+                left = deadline - time.time()
+                if left <= 0:
+                    break
+
+                self.condition.wait(left)
+
+            return self.closed
+
+    def read(self, cursor, timeout):
+        """
+        Returns the lines past the specified position, blocking until some are available, until the buffer
+        is closed or until the timeout elapses.
+
+        :type cursor: int
+        :param cursor: index of the next line to read
+        :type timeout: float
+        :param timeout: how long to wait for in seconds
+        :rtype: (list, int, bool) tuple holding the lines, the next position and whether we are done
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while 1:
+                cursor = max(cursor, self.dropped)
+                end = self.dropped + len(self.lines)
+                if cursor < end or self.closed:
+                    lines = list(self.lines)[cursor - self.dropped:]
+                    return lines, end, self.closed and not lines
+
+                left = deadline - time.time()
+                if left <= 0:
+                    return [], cursor, False
+
+                self.condition.wait(left)
+
+    def follow(self, spin=5.0):
+        """
+        Generator yielding the lines as they come in (line break included) until the buffer is closed.
+
+        :type spin: float
+        :param spin: wait timeout in seconds
+        """
+        cursor = 0
+        while 1:
+            lines, cursor, done = self.read(cursor, spin)
+            if done:
+                break
+
+            if lines:
+                yield ''.join(line + '\n' for line in lines)
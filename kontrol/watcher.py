@@ -0,0 +1,126 @@
+import etcd
+import logging
+import time
+
+from etcd import EtcdEventIndexCleared, EtcdKeyNotFound, EtcdWatchTimedOut
+from pykka.exceptions import ActorDeadError
+from threading import Event, Thread
+
+#: our ochopod logger
+logger = logging.getLogger('kontrol')
+
+"""
+    Etcd watch loop forwarding changes to a state-machine.
+"""
+
+
+class Watcher(Thread):
+    """
+    Thread following the changes made to an etcd key (or to a whole directory if recursive) starting
+    at a given index. Each change is forwarded to the actor as an *event* message:
+
+    .. code-block:: python
+
+        {'request': 'event', 'tag': tag, 'action': 'set', 'key': key, 'value': value, 'index': index}
+
+    If the index falls out of the etcd event history (compaction) or if the key vanishes while watching
+    it (non-recursive watch), a *resync* action is forwarded and the thread exits. Please note the tag is
+    used by the actor to tell apart watchers and ignore stale ones.
+
+    When idle the index is moved forward to the etcd cluster index upon each watch timeout. This keeps
+    it from falling out of the event history because of changes made to other keys.
+    """
+
+    def __init__(self, ref, host, key, index, tag, recursive=True, timeout=5.0):
+        super(Watcher, self).__init__()
+
+        #
+        # - use a dedicated client (the watch will hold its connection)
+        #
+        self.client = etcd.Client(host=host, port=2379)
+        self.daemon = True
+        self.index = index
+        self.key = key
+        self.mark = None
+        self.recursive = recursive
+        self.ref = ref
+        self.stopped = Event()
+        self.tag = tag
+        self.timeout = timeout
+
+    def stop(self):
+        """
+        Requests the thread to exit (this will happen at most after one watch timeout).
+        """
+        self.stopped.set()
+
+    def run(self):
+
+        spin = 0.25
+        try:
+            while not self.stopped.is_set():
+                try:
+
+                    #
+                    # - long-poll for the next change at or past our index
+                    # - bump the index past the change we just got
+                    #
+                    res = self.client.read(self.key, wait=True, waitIndex=self.index, recursive=self.recursive, timeout=self.timeout)
+                    self.index = res.modifiedIndex + 1
+                    self.mark = None
+                    spin = 0.25
+                    if not self.stopped.is_set():
+                        self._post(res.action, res.key, res.value, res.modifiedIndex)
+
+                except EtcdWatchTimedOut:
+
+                    #
+                    # - nothing changed on our key
+                    # - if we know the cluster index from before that watch started nothing matched up to
+                    #   it either (the watch would have returned right away) : skip past it
+                    # - fetch the current cluster index for the next watch (any read will do, it is passed
+                    #   in the response headers)
+                    #
+                    if self.mark is not None:
+                        self.index = max(self.index, self.mark + 1)
+
+                    self.mark = None
+                    try:
+                        self.mark = self.client.read('/').etcd_index
+                    except Exception:
+                        pass
+
+                except (EtcdEventIndexCleared, EtcdKeyNotFound):
+
+                    #
+                    # - our index is too old (or the key is gone)
+                    # - the actor will have to re-read and re-watch
+                    #
+                    logger.debug('watch on %s lost at index %d, requesting a resync' % (self.key, self.index))
+                    self._post('resync', self.key, None, self.index)
+                    break
+
+                except Exception as failure:
+
+                    #
+                    # - connectivity issue or the like
+                    # - back off a bit and retry from the same index
+                    #
+                    logger.debug('watch on %s failed (%s), retrying in %2.2f s' % (self.key, failure, spin))
+                    time.sleep(spin)
+                    spin = min(spin * 2, 5.0)
+
+        except ActorDeadError:
+            pass
+
+    def _post(self, action, key, value, index):
+
+        self.ref.tell(
+            {
+                'request': 'event',
+                'tag': self.tag,
+                'action': action,
+                'key': key,
+                'value': value,
+                'index': index
+            })
@@ -0,0 +1,366 @@
+import errno
+import fcntl
+import json
+import logging
+import os
+import select
+import time
+
+from kontrol.capture import CHUNK, LIMIT
+from kontrol.fsm import timers
+from kontrol.reaper import spawn, spill
+from Queue import Queue
+from subprocess import PIPE
+from threading import Lock, Thread
+
+#: our ochopod logger
+logger = logging.getLogger('kontrol')
+
+"""
+    Long-lived sub-process serving requests over a line-delimited JSON protocol.
+"""
+
+
+class Worker(object):
+    """
+    Warm sub-process started once and fed one request at a time on its standard input. This removes the
+    process startup cost from each invocation. The protocol is line-delimited JSON:
+
+    - the worker is started with *$WORKER* set and writes *{"ready": true}* on its standard output once up.
+    - each request is written on its standard input as *{"id": 1, "cmd": "...", "env": {...}}*.
+    - the worker answers on its standard output with *{"id": 1, "code": 0, "stdout": "..."}*.
+
+    Variables larger than *inline* bytes are written to temporary files (see :func:`kontrol.reaper.spill`)
+    and requests are written from a dedicated thread, so that a busy worker never blocks the actor nor the
+    capture threads. Anything else written on the standard output is ignored and the standard error is
+    forwarded to the sink. Each line is kept whole up to *limit* bytes : a longer answer fails the request
+    (the worker keeps running). A worker that does not report ready in time or that does not answer a request before its
+    *deadline* is killed. Both are checked by :meth:`Job.done` (the actor is sent an *overdue* message via
+    the shared timer heap when either one elapses). A worker that dies is restarted upon the next request,
+    unless it failed several times in a row in which case the worker is disabled and :meth:`submit` returns
+    None (the caller is then expected to fall back to a one-shot sub-process). Failed requests are reported
+    by :meth:`Job.done`.
+    """
+
+    #: how many consecutive failures before giving up
+    retries = 3
+
+    def __init__(self, ref, cmd, shell=False, timeout=5.0, deadline=60.0, limit=LIMIT, inline=65536, sink=None):
+
+        self.child = None
+        self.cmd = cmd
+        self.deadline = deadline
+        self.disabled = False
+        self.failures = 0
+        self.inline = inline
+        self.job = None
+        self.killed = False
+        self.limit = limit
+        self.lock = Lock()
+        self.ready = False
+        self.ref = ref
+        self.seq = 0
+        self.shell = shell
+        self.started = None
+        self.sink = sink
+        self.timeout = timeout
+        self.writer = None
+
+    def submit(self, cmd, env):
+        """
+        Sends a request to the worker, starting (or restarting) it if needed.
+
+        :type cmd: str
+        :param cmd: the command the request is for
+        :type env: dict
+        :param env: the request environment variables
+        :rtype: :class:`Job`
+        """
+        if self.disabled:
+            return None
+
+        if self.child is None or self.killed or self.child.done() is not None:
+
+            #
+            # - the worker died on its own (e.g it crashed) or we killed it because it was late
+            # - give up after a few consecutive failures
+            #
+            if self.child is not None and not self.killed:
+                self.failures += 1
+
+            if self.failures >= self.retries:
+                logger.warning('worker "%s" failed %d times, disabling it' % (self.cmd, self.failures))
+                self.disabled = True
+                return None
+
+            self._start()
+
+        env, files = spill(env, self.inline)
+        with self.lock:
+            self.seq += 1
+            self.job = Job(self, self.child, self.seq, cmd, env, files)
+            if self.ready:
+                self._send(self.job)
+
+            self.job.entry = timers().schedule(self.ref, {'request': 'overdue', 'pid': self.child.pid}, self.deadline)
+            return self.job
+
+    def kill(self):
+        """
+        Kills the worker (it will be restarted upon the next request).
+        """
+        if self.child:
+            self.killed = True
+            self.child.kill()
+
+    def stop(self):
+        """
+        Closes the worker standard input (which should make it exit) and kills it.
+        """
+        if self.child:
+            self.writer.stop()
+            self.kill()
+
+    def _start(self):
+
+        #
+        # - the worker outputs are drained and parsed line by line by the capture threads
+        # - lines are never split, up to $KONTROL_BUFFER bytes
+        # - we don't need to keep much of it around
+        # - wake the actor up once the worker should have reported ready (see _overdue())
+        # - run it in its own process group so that killing it also kills whatever it started (for
+        #   instance when the command is run through a shell)
+        # - the requests are written by a dedicated thread (one per worker process)
+        #
+        if self.writer:
+            self.writer.stop()
+
+        self.job = None
+        self.killed = False
+        self.ready = False
+        self.started = time.time()
+        self.child = spawn(self.ref, self.cmd,
+        close_fds=True,
+        shell=self.shell,
+        bufsize=0,
+        env={'WORKER': '1'},
+        preexec_fn=os.setsid,
+        stdin=PIPE,
+        stderr=PIPE,
+        stdout=PIPE,
+        limit=CHUNK,
+        overflow='truncate',
+        sink=self._sink,
+        width=self.limit)
+
+        self.writer = _Writer(self.child.popen.stdin)
+        self.writer.start()
+        timers().schedule(self.ref, {'request': 'overdue', 'pid': self.child.pid}, self.timeout)
+        logger.debug('worker "%s" started (pid %s)' % (self.cmd, self.child.pid))
+
+    def _overdue(self, job):
+
+        #
+        # - invoked from the actor (see Job.done())
+        # - kill the worker if it did not report ready in time or if it did not answer before the deadline
+        # - this counts as a failure and the request is reported as failed right away
+        #
+        now = time.time()
+        with self.lock:
+            if job is not self.job or job.child is not self.child or self.killed:
+                return
+
+            if not self.ready and now - self.started >= self.timeout:
+                logger.warning('worker "%s" not ready after %2.1f s, killing it' % (self.cmd, self.timeout))
+
+            elif now - job.tick >= self.deadline:
+                logger.warning('worker "%s" silent after %2.1f s, killing it' % (self.cmd, self.deadline))
+
+            else:
+                return
+
+            self.failures += 1
+            self.killed = True
+            self.job = None
+            job.failed = True
+            job.child.kill()
+
+    def _send(self, job):
+
+        #
+        # - invoked with our lock held : never write to the pipe from here as the worker may not be
+        #   reading it (this would block the capture threads waiting on that lock)
+        # - hand the request over to our writer thread as one single line
+        #
+        job.sent = True
+        self.writer.queue.put(json.dumps({'id': job.id, 'cmd': job.cmd, 'env': job.env}) + '\n')
+
+    def _sink(self, pid, tag, line):
+
+        #
+        # - invoked from the capture threads
+        # - parse the worker stdout lines, forward anything else to our sink
+        #
+        if tag == 'stdout' and line is None:
+
+            #
+            # - the line was too long and got dropped, assume it was our answer
+            # - fail the request and wake the actor up
+            #
+            with self.lock:
+                if self.child and pid == self.child.pid and self.job:
+                    logger.warning('worker "%s" answer exceeds %d bytes' % (self.cmd, self.limit))
+                    self.job.failed = True
+                    timers().discard(self.job.entry)
+                    self.job = None
+                    self.ref.tell({'request': 'answered', 'pid': pid})
+            return
+
+        js = None
+        if tag == 'stdout':
+            try:
+                js = json.loads(line)
+            except ValueError:
+                pass
+
+        if not isinstance(js, dict):
+            if self.sink:
+                self.sink(pid, tag, line)
+            return
+
+        with self.lock:
+            if self.child is None or pid != self.child.pid:
+                return
+
+            if js.get('ready') and not self.ready:
+                self.ready = True
+                logger.debug('worker "%s" ready (pid %s)' % (self.cmd, pid))
+                if self.job:
+                    self._send(self.job)
+
+            elif self.job and js.get('id') == self.job.id:
+                self.failures = 0
+                self.job.reply = js
+                self.job.lapse = time.time() - self.job.tick
+                timers().discard(self.job.entry)
+                self.job = None
+                self.ref.tell({'request': 'answered', 'pid': pid})
+
+
+class Job(object):
+    """
+    Handle on a request sent to a :class:`Worker`, mimicking :class:`kontrol.reaper.Child` (e.g what the
+    actors use to track a one-shot sub-process).
+    """
+
+    def __init__(self, worker, child, id, cmd, env, files):
+
+        self.child = child
+        self.cmd = cmd
+        self.entry = None
+        self.env = env
+        self.failed = False
+        self.files = files
+        self.id = id
+        self.lapse = 0.0
+        self.pid = child.pid
+        self.reply = None
+        self.sent = False
+        self.stdout = _Output(self)
+        self.tick = time.time()
+        self.worker = worker
+
+    def close(self):
+        """
+        Removes the temporary files holding the spilled variables, if any.
+        """
+        for path in self.files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        self.files = []
+
+    def kill(self):
+        self.worker.kill()
+
+    def done(self):
+        """
+        Returns the outcome once the worker answered, None otherwise. The *failed* flag is set if the worker
+        died before answering or if its answer was too long, in which case *sent* tells whether the request
+        made it to the worker (e.g it did not if the worker never reported ready).
+
+        :rtype: dict
+        """
+        if self.reply is not None:
+            return {'code': self.reply.get('code', 0), 'lapse': self.lapse, 'user': 0.0, 'system': 0.0, 'rss': 0}
+
+        if not self.failed and self.child.done() is None:
+            self.worker._overdue(self)
+
+        if self.failed or self.child.done() is not None:
+            return {'code': None, 'lapse': time.time() - self.tick, 'user': 0.0, 'system': 0.0, 'rss': 0, 'failed': True, 'sent': self.sent}
+
+        return None
+
+
+class _Writer(Thread):
+    """
+    Thread writing the requests to the worker standard input. The pipe is switched to non-blocking mode and
+    we wait for it to drain using select(), which keeps us from freezing the hub in green mode.
+    """
+
+    def __init__(self, pipe):
+        super(_Writer, self).__init__()
+
+        self.daemon = True
+        self.pipe = pipe
+        self.queue = Queue()
+
+    def stop(self):
+        """
+        Closes the pipe once whatever is queued is written (which should make the worker exit).
+        """
+        self.queue.put(None)
+
+    def run(self):
+
+        fd = self.pipe.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        try:
+            while 1:
+                data = self.queue.get()
+                if data is None:
+                    break
+
+                while data:
+                    try:
+                        select.select([], [fd], [])
+                        data = data[os.write(fd, data):]
+
+                    except (OSError, select.error) as failure:
+                        if failure.args[0] not in [errno.EAGAIN, errno.EINTR]:
+                            raise
+
+        except (IOError, OSError, select.error):
+
+            #
+            # - the worker is gone, the reaper will notify the actor
+            #
+            pass
+
+        finally:
+            self.pipe.close()
+
+
+class _Output(object):
+
+    def __init__(self, job):
+        self.job = job
+
+    def text(self, limit=None):
+        return self.job.reply.get('stdout', '') if self.job.reply else ''
+
+    def lines(self, limit=None):
+        return self.text().splitlines()